@@ -6,61 +6,424 @@
 #
 from __future__ import print_function
 
-import pprint
 import os.path
 import sys
-import requests
 import json
+import codecs
+import csv
+import io
 import re
-from prettytable import PrettyTable
+import hashlib
+import urllib.parse
 import argparse
-
-import yaml
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from collections.abc import MutableMapping
+import threading
+import gc
+from contextlib import contextmanager
+
+# snapshot rows are lists of SNAPSHOT_FIELDS: the first SNAPSHOT_KEY are the key, the first SNAPSHOT_COMPARED are diffed
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FIELDS = [ 'type', 'serial', 'location', 'brand', 'model', 'extra', 'sources' ]
+SNAPSHOT_KEY = 3
+SNAPSHOT_COMPARED = 6
+SNAPSHOT_HASH_MASK = (1 << 128) - 1
+
+# the parsed rules file kept in --cache-dir, see load_config()
+CONFIG_CACHE_VERSION = 2
+
+# requests, urllib3, prettytable, yaml, pprint, multiprocessing and asyncio are imported when first needed: a run with a cached rules file and
+# --output csv (or a library user only reading the DB) never loads the output stack, and --offline not the HTTP one
+
+
+
+@contextmanager
+def paused_gc():
+    """
+    Pauses the cyclic garbage collector while building many small containers that do not form cycles (its
+    collections would otherwise make that quadratic)
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# the PrometheusInventory of a worker process of process_parallel(), see init_worker()
+WORKER = None
+
+
+def init_worker(options, federated):
+    """ Starts a worker of process_parallel(): a runner of its own, which only turns results into rows """
+    global WORKER
+    WORKER = PrometheusInventory(options)
+    WORKER.federated = federated
+
+
+def process_task(task):
+    """ Runs in a worker of process_parallel(): the rows of a rule on an endpoint, from its results and lookups, unmerged """
+    m, result, lookups, endpoint = task
+    start = time.perf_counter()
+    rows = list(WORKER.process_rows(m, result, lookups, endpoint))
+    return rows, time.perf_counter() - start
+
 
 DESCRIPTION = """Collects inventory data from Prometheus"""
 VERSION = '0.0.1'
 
 
+class CompiledRule(namedtuple('CompiledRule', ['name', 'metric', 'type', 'collisions', 'labelmap', 'extra', 'regexp', 'static',
+                                               'ignore', 'join', 'index', 'fields', 'signature', 'config'])):
+    """
+    A rule of the rules file (or one of its joins), as compiled by PrometheusInventory.compile_rule(). Meant to be
+    read-only: it is shared by every row processed with it. Fields can also be read as rule['metric'] (or with
+    rule.get(), and 'metric' in rule), unknown ones raising KeyError as with the rule dicts.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+
+Correlation = namedtuple('Correlation', ['type', 'primary', 'secondary', 'fields', 'whitespace', 'case', 'prefixes'])
+Correlation.__doc__ = """ An entry of correlate: in the rules file, as compiled by PrometheusInventory.compile_correlation() """
+
+RuleResult = namedtuple('RuleResult', ['rule', 'endpoint', 'rows', 'error'])
+RuleResult.__doc__ = """
+A rule processed on an endpoint (its URL), as yielded by PrometheusInventory.aiter_rules(): the rows it added to the DB
+(not those merged into existing rows) and its error, None if all its queries succeeded
+"""
+
+
+class SourceList(list):
+    """
+    The sources of an InventoryRecord, as row['sources'] returns them: a list built from its source ids, so changing
+    it in place would be lost. Those changes raise TypeError; assign row['sources'] instead (+= does).
+    """
+    def readonly(self, *args, **kwargs):
+        raise TypeError("the sources of a row can't be changed in place, assign row['sources'] instead")
+
+    append = extend = insert = remove = pop = clear = sort = reverse = __setitem__ = __delitem__ = __imul__ = readonly
+
+    def __iadd__(self, other):
+        return list(self) + list(other)
+
+    def __reduce_ex__(self, protocol):
+        # copied and pickled as a plain list (unpickling a list subclass would extend() it)
+        return (list, (list(self), ))
+
+
+class InventoryRecord(MutableMapping):
+    """
+    A DB row. Behaves like the dict rows it replaces (row['serial'], row.get(...), 'ignored' in row, dict(row), ...),
+    but keeps the usual fields in slots, interns the strings repeated across rows, and stores sources as a tuple of
+    ids into a table shared by all records (row['sources'] is a SourceList, assign it to change them). Fields other
+    than the usual ones (e.g. from regexp groups) are kept in a dict, created when needed.
+    """
+    __slots__ = ('type', 'brand', 'model', 'serial', 'location', 'extra', 'collisions', 'ignored', '_sources', '_fields')
+
+    FIELDS = ('type', 'brand', 'model', 'serial', 'location', 'extra', 'sources', 'collisions')
+    INTERNED = frozenset(['type', 'brand', 'model', 'location', 'collisions'])
+    SLOTTED = frozenset(['type', 'brand', 'model', 'serial', 'location', 'extra', 'collisions'])
+    SOURCE_NAMES = []
+    SOURCE_IDS = {}
+    source_lock = threading.Lock()
+
+    def __init__(self, type='', collisions='', sources=()):
+        self.type = sys.intern(type) if isinstance(type, str) else type
+        self.brand = ''
+        self.model = ''
+        self.serial = ''
+        self.location = ''
+        self.extra = []
+        self.collisions = collisions
+        self._sources = self.source_ids(sources)
+        self._fields = None
+
+    @classmethod
+    def source_ids(cls, names):
+        ids = cls.SOURCE_IDS
+        try:
+            return tuple([ ids[name] for name in names ])
+        except KeyError:
+            with cls.source_lock:
+                for name in names:
+                    if name not in ids:
+                        cls.SOURCE_NAMES.append(sys.intern(name))
+                        ids[name] = len(cls.SOURCE_NAMES) - 1
+            return tuple([ ids[name] for name in names ])
+
+    def __getitem__(self, key):
+        if key in self.SLOTTED:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if key == 'sources':
+            names = self.SOURCE_NAMES
+            return SourceList([ names[i] for i in self._sources ])
+        if key == 'ignored':
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._fields is None:
+            raise KeyError(key)
+        return self._fields[key]
+
+    def __setitem__(self, key, value):
+        if key == 'sources':
+            self._sources = self.source_ids(value)
+        elif key in self.FIELDS or key == 'ignored':
+            if key in self.INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._fields is None:
+                self._fields = {}
+            self._fields[key] = value
+
+    def __delitem__(self, key):
+        if key == 'ignored' and hasattr(self, 'ignored'):
+            del self.ignored
+        elif key not in self.FIELDS and self._fields is not None and key in self._fields:
+            del self._fields[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            yield key
+        if hasattr(self, 'ignored'):
+            yield 'ignored'
+        if self._fields is not None:
+            for key in self._fields:
+                yield key
+
+    def __len__(self):
+        return len(self.FIELDS) + hasattr(self, 'ignored') + (len(self._fields) if self._fields is not None else 0)
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return True
+        if key == 'ignored':
+            return hasattr(self, 'ignored')
+        return self._fields is not None and key in self._fields
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __getstate__(self):
+        # source ids are only meaningful in this process, sent by name
+        return (self.type, self.brand, self.model, self.serial, self.location, self.extra, self.collisions,
+                self['sources'], getattr(self, 'ignored', None), self._fields)
+
+    def __setstate__(self, state):
+        self.type, self.brand, self.model, self.serial, self.location, self.extra, self.collisions, sources, ignored, self._fields = state
+        self._sources = self.source_ids(sources)
+        if ignored is not None:
+            self.ignored = ignored
+
+
+class InventoryDB(list):
+    """
+    The list of DB rows, with a hash index on the fields used to detect collisions (type, model, location), so
+    that push_row() doesn't need to scan the whole DB for each row. Appending keeps the index up to date, any other
+    change to the list rebuilds it. Call reindex() after changing the type, model or location of a row in place.
+
+    select() looks rows up by the INDEXED_FIELDS with secondary indexes (of row positions), each built the first time
+    it is needed and kept up to date by appends. Call invalidate() after changing one of them in place.
+    """
+    INDEXED_FIELDS = ( 'type', 'location', 'serial', 'brand' )
+
+    def __init__(self, rows=()):
+        super().__init__(rows)
+        self.reindex()
+
+    @staticmethod
+    def collision_key(r):
+        return (r['type'], r['model'], r['location'])
+
+    def reindex(self):
+        self.index = {}
+        self.indexes = {}
+        for r in self:
+            self.index.setdefault(self.collision_key(r), []).append(r)
+
+    def invalidate(self):
+        """ Drops the secondary indexes, they are rebuilt when needed again """
+        self.indexes = {}
+
+    def get_secondary_index(self, field):
+        """ { value: [ positions of the rows with that value in field ] } """
+        index = self.indexes.get(field)
+        if index is None:
+            index = {}
+            for i, r in enumerate(self):
+                index.setdefault(r[field], []).append(i)
+            self.indexes[field] = index
+        return index
+
+    @staticmethod
+    def matches(value, predicate):
+        """ True if value satisfies the predicate: a string (equal), a list/tuple/set of strings (any) or a regexp (match) """
+        if isinstance(predicate, str):
+            return value == predicate
+        if hasattr(predicate, 'match'):
+            return isinstance(value, str) and predicate.match(value) is not None
+        return isinstance(value, str) and value in predicate
+
+    def get_candidates(self, field, predicate):
+        """ The positions of the rows whose field may satisfy predicate, in DB order """
+        index = self.get_secondary_index(field)
+        if isinstance(predicate, str):
+            return index.get(predicate, [])
+        if hasattr(predicate, 'match'):
+            lists = [ positions for value, positions in index.items() if isinstance(value, str) and predicate.match(value) is not None ]
+        else:
+            lists = [ index.get(value, []) for value in set(predicate) ]
+        if len(lists) == 1:
+            return lists[0]
+        return sorted([ i for positions in lists for i in positions ])
+
+    def select(self, include=None, exclude=None):
+        """
+        The rows, in DB order, satisfying every predicate of include and none of exclude, both { field: predicate } (see
+        matches()). Candidates come from the most selective index among the included INDEXED_FIELDS, so repeated
+        lookups cost about the size of their result instead of the size of the DB.
+        """
+        include = include or {}
+        exclude = exclude or {}
+        candidates = None
+        for field, predicate in include.items():
+            if field in self.INDEXED_FIELDS:
+                positions = self.get_candidates(field, predicate)
+                if candidates is None or len(positions) < len(candidates):
+                    candidates = positions
+        rows = self if candidates is None else [ self[i] for i in candidates ]
+        matches = self.matches
+        return [ r for r in rows if all([ matches(r[f], p) for f, p in include.items() ]) and not any([ matches(r[f], p) for f, p in exclude.items() ]) ]
+
+    def find_collisions(self, r):
+        """ Rows colliding with r, in the order they were added """
+        return self.index.get(self.collision_key(r), [])
+
+    def append(self, r):
+        super().append(r)
+        self.index.setdefault(self.collision_key(r), []).append(r)
+        for field, index in self.indexes.items():
+            index.setdefault(r[field], []).append(len(self) - 1)
+
+    def extend(self, rows):
+        for r in rows:
+            self.append(r)
+
+    def __iadd__(self, rows):
+        self.extend(rows)
+        return self
+
+    def _reindexing(method):
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            self.reindex()
+            return result
+        return wrapper
+
+    insert = _reindexing(list.insert)
+    remove = _reindexing(list.remove)
+    pop = _reindexing(list.pop)
+    clear = _reindexing(list.clear)
+    sort = _reindexing(list.sort)
+    reverse = _reindexing(list.reverse)
+    __setitem__ = _reindexing(list.__setitem__)
+    __delitem__ = _reindexing(list.__delitem__)
+    del _reindexing
+
+
 class PrometheusInventory:
 
     MAP = None
+    RULES = None
     DEBUG = 0
     MSGFD = None
     options = None
     DB = []
     FILTER = {}
     EXCLUSION = {}
+    FAILURES = {}
+    ERRORS = {}
     CACHE = {}
+    FAILED_QUERIES = {}
+    LOOKUPS = {}
+    QUERIES = {}
+    PROJECTED = set()
+    REQUIRED = {}
+    SELECTORS = {}
+    PROJECTIONS = {}
+    OUTPUT_CHUNK = 1000
+    # shards are split by the next character of the --shard-label value, in these classes ('' is any other)
+    SHARD_CLASSES = [ '0123', '4567', '89', 'ABCDEFGHIJKLM', 'NOPQRSTUVWXYZ', 'abcdefgh', 'ijklmnop', 'qrstuvwxyz', '' ]
+    # query.max-samples (422) and proxies' body size limits (413)
+    SIZE_ERRORS = [ 'http code: 413', 'http code: 422' ]
+    # a 422 is any error evaluating a query: only these (Prometheus, Thanos, Cortex/Mimir limits) are about its size
+    SIZE_ERROR_MESSAGES = re.compile(r'too many samples|max(imum)? number of (series|samples|chunks)|(series|samples?|chunks?) limit', re.I)
+    CHANGES = None
+    PROFILE = None
+    CORRELATIONS = []
+    current_rule = None
 
     last_error = None
+    disk_cache_written = False
+    session = None
+    credentials = None
+    federated = False
 
     def __init__(self, options):
-        self.DB = []
+        self.DB = InventoryDB()
         self.CACHE = {}
+        self.FAILED_QUERIES = {}
+        self.LOOKUPS = {}
+        self.QUERIES = {}
+        self.SELECTORS = {}
+        self.PROJECTIONS = {}
         self.options = options
+        self.session = None
+        self.session_lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+        # the cancellation and deadline of the aiter_rules() run a thread works for, see set_run_state()
+        self.run_state = threading.local()
+        if 'PROMCRED' in os.environ:
+            self.credentials = tuple(os.environ['PROMCRED'].split(':', 1))
         if os.environ.get('KUBERNETES_PORT'):
             self.MSGFD = sys.stdout
         else:
             #self.MSGFD = sys.stderr
             self.MSGFD = sys.stdout
 
-        filter = self.options.filter.split(',')
-        exclusion = self.options.exclude.split(',')
+        self.FAILURES = {}
+        self.ERRORS = {}
+        self.FILTER = {}
+        self.EXCLUSION = {}
         if len(self.options.filter)>0:
-            for f in filter:
-                k,v = f.split('=')
-                self.FILTER.update( {k: v} )
-        elif len(self.options.exclude)>0:
-            for f in exclusion:
-                k,v = f.split('=')
-                self.EXCLUSION.update( {k: v} )
-
-        # skip-ssl: For requests >= 2.16.0
-        import urllib3
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        # skip-ssl: For requests < 2.16.0
-        requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+            self.FILTER = self.parse_filter(self.options.filter)
+        if len(self.options.exclude)>0:
+            self.EXCLUSION = self.parse_filter(self.options.exclude)
 
         # https://github.com/yaml/pyyaml/wiki/PyYAML-yaml.load(input)-Deprecation
         #yaml.warnings({'YAMLLoadWarning': False})
@@ -76,83 +439,875 @@ class PrometheusInventory:
     def setDebug(self, d):
         self.options.debug = d
 
+    def get_option(self, name, default=None):
+        # options may come from parse_options() or be assembled by hand when used as a module
+        return getattr(self.options, name, default)
+
     def get_last_error(self):
         return self.last_error
 
+    def get_msgfd(self):
+        """ Where messages go: MSGFD, or stderr with a machine --output, so that stdout only has the rows """
+        if self.get_option('output', 'table') != 'table':
+            return sys.stderr
+        return self.MSGFD
+
     def info(self, args):
-        print("[i] " + args)
+        print("[i] " + args, file=self.get_msgfd())
 
     def error(self, args):
         self.last_error = args
-        print("[ERROR] " + args)
+        print("[ERROR] " + args, file=self.get_msgfd())
 
-    def debug(self, level, args):
+    def debug(self, level, args, *fmtargs):
+        """ Prints args % fmtargs at the given debug level. Only formats when enabled, so pass the values as fmtargs """
         if self.getDebug()>=level:
-            print("[D:" + str(level) + "] " + args, file=self.MSGFD)
+            if fmtargs:
+                args = args % fmtargs
+            print("[D:" + str(level) + "] " + args, file=self.get_msgfd())
 
     def debug_var(self, level, arg):
         if self.getDebug()>=level:
-            self.debug( level, pprint.pformat(arg) )
+            import pprint
+            self.debug( level, '%s', pprint.pformat(arg) )
 
     def load_config(self):
-        with open(self.options.config) as f:
-            self.MAP = yaml.load(f)
+        """
+        Loads and compiles the rules file. With --cache-dir, the parsed rules file is kept there (as JSON, it is only
+        compiled again) and reused for as long as the file keeps its mtime and size or, failing that, its content hash.
+        """
+        path = self.options.config
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            cachepath = self.get_config_cache_path(path)
+            cached = self.get_config_cache(cachepath)
+            if cached is not None and cached['mtime'] == st.st_mtime_ns and cached['size'] == st.st_size:
+                self.debug(2, '[load_config] using %s', cachepath)
+            else:
+                content = f.read()
+                sha = hashlib.sha256(content).hexdigest()
+                if cached is None or cached['sha'] != sha:
+                    cached = {'sha': sha, 'map': self.parse_config(content)}
+                cached.update({'mtime': st.st_mtime_ns, 'size': st.st_size})
+                self.set_config_cache(cachepath, cached)
+        config = cached['map']
+        self.MAP = config
+        self.RULES = self.compile_config(config)
+        self.CORRELATIONS = [ self.compile_correlation(c) for c in config.get('correlate') or [] ]
+
+    @staticmethod
+    def parse_config(content):
+        """ The rules file, parsed with the libyaml based loader if PyYAML has it """
+        import yaml
+        return yaml.load(content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    def get_config_cache_path(self, path):
+        if not self.get_option('cache_dir'):
+            return None
+        return os.path.join(self.get_option('cache_dir'), 'config-' + hashlib.sha1(os.path.abspath(path).encode('UTF-8')).hexdigest()[:16] + '.json')
+
+    @staticmethod
+    def get_config_cache_format():
+        return [ CONFIG_CACHE_VERSION, VERSION ]
+
+    def get_config_cache(self, cachepath):
+        """ The cached rules file: data only (JSON), as --cache-dir may be shared, so it is compiled by load_config() """
+        if cachepath is None:
+            return None
+        try:
+            with open(cachepath, 'rb') as f:
+                cached = json.loads(f.read().decode('UTF-8'))
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get('format') != self.get_config_cache_format() or not isinstance(cached.get('map'), dict):
+            return None
+        return cached
+
+    def set_config_cache(self, cachepath, cached):
+        if cachepath is None:
+            return
+        cached['format'] = self.get_config_cache_format()
+        try:
+            content = json.dumps(cached)
+        except (TypeError, ValueError):
+            content = None
+        if content is None or json.loads(content)['map'] != cached['map']:
+            # YAML that JSON cannot hold the same (dates, non-string keys): parsed each time
+            self.debug(1, '[load_config] not caching %s: not representable as JSON', self.options.config)
+            return
+        tmppath = cachepath + '.' + str(os.getpid()) + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+            with open(tmppath, 'w') as f:
+                f.write(content)
+            os.replace(tmppath, cachepath)
+        except OSError as e:
+            self.debug(1, '[load_config] could not write %s: %s', cachepath, e)
 
     def push_row(self, r, targetDb):
         # check for duplicates - this block could well be very specific.... and turn out to be very difficult
-        if r['collisions'] in ['override']:
+        # a row without brand nor serial has nothing to contribute to a colliding row
+        if r['collisions'] in ['override'] and (r['brand'] != '' or r['serial'] != ''):
             updated = False
-            for dr in targetDb:
+            if isinstance(targetDb, InventoryDB):
+                candidates = targetDb.find_collisions(r)
+            else:
+                candidates = targetDb
+            for dr in candidates:
                 if dr['type'] == r['type'] and dr['model'] == r['model'] and dr['location'] == r['location']:
                     if dr['brand'] == '' and r['brand'] != '':
-                        self.debug(4, "     [push_row] collision in brand:\ndr=" + str(dr) + "\nr=" + str(r))
+                        self.debug(4, "     [push_row] collision in brand:\ndr=%s\nr=%s", dr, r)
                         dr['brand'] = r['brand']
                         if r['sources'] not in dr['sources']:
                             dr['sources'] += r['sources']
                         updated = True
                     if dr['serial'] == '' and r['serial'] != '':
-                        self.debug(4, "     [push_row] collision in serial\ndr=" + str(dr) + "\nr=" + str(r))
+                        self.debug(4, "     [push_row] collision in serial\ndr=%s\nr=%s", dr, r)
                         dr['serial'] = r['serial']
                         if r['sources'] not in dr['sources']:
                             dr['sources'] += r['sources']
                         updated = True
                     if updated:
+                        if isinstance(targetDb, InventoryDB):
+                            targetDb.invalidate()
                         return
-        self.debug(4, "   [push_row] adding: " + str(r))
+        self.debug(4, "   [push_row] adding: %s", r)
         targetDb += [ r ]
 
-    def check_if_ignore(self, row, m):
-        for ignrule in m['ignore_regexp']:
-            self.debug(4, '   [check_if_ignore] ignrule: ' + str(ignrule) + ', against: ' + str(row['metric']))
-            for ignfield, ignexp in ignrule.items():
-                # special case, when we want to match missing labels (as we cannot match against, e.g., the empty content because it's missing)
-                if not ignexp and ignfield not in row['metric']:
-                    self.debug(4, '   [check_if_ignore] ignrule matched!')
+    def check_if_ignore(self, labels, m):
+        for ignfield, ignexp in m.ignore:
+            # special case, when we want to match missing labels (as we cannot match against, e.g., the empty content because it's missing)
+            if ignexp is None:
+                if ignfield not in labels:
                     return True
-                if ignfield in row['metric'] and ignexp and re.match(ignexp, row['metric'][ignfield]):
-                    #self.debug(3, '   [check_if_ignore] ignrule matched!')
-                    return True
-        self.debug(4, '   [check_if_ignore] ignrule did not match!')
+            elif ignfield in labels and ignexp.match(labels[ignfield]):
+                return True
         return False
 
-    def get_uri(self, entry):
-        return self.options.prom_endpoint + '/api/v1/query?query=' + entry['metric']
+    def get_endpoints(self):
+        """
+        Returns the list of endpoints to collect from, as dicts with 'url' and 'auth'. They come from -u (repeated,
+        or comma separated) and from --endpoints-file, which lists one "<url> [<user>:<password>]" per line ('#' starts
+        a comment at the start of a line or after a space, so URLs and passwords can have it). Endpoints without their own credentials use PROMCRED. Raises ValueError if there are none, or credentials are
+        not user:password.
+        """
+        urls = self.options.prom_endpoint or []
+        if not isinstance(urls, list):
+            urls = [ urls ]
+        lines = []
+        for url in urls:
+            lines += url.split(',')
+        if self.get_option('endpoints_file'):
+            with open(self.get_option('endpoints_file')) as f:
+                lines += f.readlines()
+        endpoints = []
+        for line in lines:
+            fields = re.split(r'(?:^|\s)#', line, maxsplit=1)[0].split()
+            if len(fields) <= 0:
+                continue
+            auth = self.credentials
+            if len(fields) > 1:
+                auth = tuple(fields[1].split(':', 1))
+            if auth is not None and len(auth) != 2:
+                raise ValueError('credentials for ' + fields[0] + ' must be <user>:<password>')
+            endpoints += [ {'url': fields[0].rstrip('/'), 'auth': auth} ]
+        if len(endpoints) == 0:
+            raise ValueError('no Prometheus endpoint, give one with -u or --endpoints-file')
+        return endpoints
+
+    def get_endpoint(self, endpoint=None):
+        if endpoint is None:
+            return self.get_endpoints()[0]
+        return endpoint
 
-    def get_results(self, entry):
-        if entry['metric'] in self.CACHE:
-            self.debug(2, ' [get_results] returning cached results for: ' + entry['metric'])
-            return self.CACHE[entry['metric']]
-        uri = self.get_uri(entry)
-        self.debug(2, ' [get_results] querying: ' + str(uri))
-        if 'PROMCRED' in os.environ:
-            xu, xp = os.environ['PROMCRED'].split(':')
-            r = requests.get(uri, verify=False, auth=(xu, xp))
+    def get_query(self, entry, shard=None):
+        """ The PromQL planned for the entry's metric by plan_queries() (only for the series of shard), or the bare metric name """
+        matchers = self.get_shard_matchers(shard) if shard else []
+        if len(matchers) == 0:
+            return self.QUERIES.get(entry['metric'], entry['metric'])
+        return self.build_query(entry['metric'], self.SELECTORS.get(entry['metric'], []) + matchers)
+
+    def get_uri(self, entry, endpoint=None, query=None):
+        if query is None:
+            query = self.get_query(entry)
+        return self.get_endpoint(endpoint)['url'] + '/api/v1/query?query=' + urllib.parse.quote(query)
+
+    @staticmethod
+    def parse_duration(text):
+        """ Seconds in a Prometheus-like duration: 90, 90s, 30m, 6h, 7d, 1w """
+        units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+        text = str(text).strip()
+        if text[-1:] in units:
+            return float(text[:-1]) * units[text[-1]]
+        return float(text)
+
+    def get_lookback(self):
+        return self.parse_duration(self.get_option('lookback', '') or 0)
+
+    def get_lookback_queries(self, entry, shard=None):
+        """
+        With --lookback, the queries standing for the entry's planned query: the time of the last sample of each
+        series within the lookback, one query per --lookback-window (newest first), so that long lookbacks do not
+        come back as a single huge response
+        """
+        lookback = int(self.get_lookback())
+        window = int(self.parse_duration(self.get_option('lookback_window', '') or lookback))
+        step = int(self.parse_duration(self.get_option('lookback_step', '') or 300))
+        window = max(step, min(window, lookback))
+        queries = []
+        offset = 0
+        while offset < lookback:
+            size = min(window, lookback - offset)
+            query = 'last_over_time(timestamp(' + self.get_query(entry, shard) + ')[%ds:%ds]' % (size, step)
+            if offset > 0:
+                query += ' offset %ds' % offset
+            queries += [ query + ')' ]
+            offset += size
+        return queries
+
+    def get_session(self):
+        """
+        Returns the HTTP session shared by all queries (and prefetch threads), so that connections to
+        Prometheus are kept alive and reused instead of being set up for each query
+        """
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                import urllib3
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                # skip-ssl: For requests >= 2.16.0
+                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+                # skip-ssl: For requests < 2.16.0
+                requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+                retries = int(self.get_option('retries', 3))
+                runner = self
+
+                class DeadlineRetry(Retry):
+                    """ Retry, but not past the deadline of the run (see get_time_left()) """
+
+                    def is_exhausted(self):
+                        return super().is_exhausted() or runner.get_time_left() == 0
+
+                    def get_backoff_time(self):
+                        left = runner.get_time_left()
+                        return super().get_backoff_time() if left is None else min(super().get_backoff_time(), left)
+
+                retry = DeadlineRetry(total=retries, connect=retries, read=retries, status=retries,
+                              backoff_factor=float(self.get_option('retry_backoff', 0.5)),
+                              status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+                poolsize = max(1, int(self.get_option('concurrency', 4)))
+                # shards are fetched from within prefetch threads: wait for a connection, so that there are never more
+                # than --concurrency queries per endpoint
+                adapter = HTTPAdapter(pool_connections=max(poolsize, len(self.get_endpoints())), pool_maxsize=poolsize, max_retries=retry,
+                                      pool_block=True)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                # skip-ssl
+                session.verify = False
+                session.headers['Accept-Encoding'] = 'identity' if self.get_option('no_gzip', False) else 'gzip'
+                self.session = session
+            return self.session
+
+    def get_timeout(self):
+        """ The (connect, read) timeouts of a query: never past the deadline of the run """
+        timeout = (float(self.get_option('connect_timeout', 5)), float(self.get_option('read_timeout', 60)))
+        left = self.get_time_left()
+        if left is not None:
+            timeout = (min(timeout[0], left), min(timeout[1], left))
+        return timeout
+
+    def set_run_state(self, cancelled=None, expires=None):
+        """
+        Ties the current thread to a run of aiter_rules(): once the Event cancelled is set, or past expires (as
+        time.monotonic()), fetch() starts no more queries. Other threads, and later runs, are not affected.
+        """
+        self.run_state.cancelled = cancelled
+        self.run_state.expires = expires
+
+    def get_run_state(self):
+        """ The arguments of set_run_state() for the current thread, to pass them on to the threads it starts """
+        return (getattr(self.run_state, 'cancelled', None), getattr(self.run_state, 'expires', None))
+
+    def get_time_left(self):
+        """ Seconds left before the deadline of the run of the current thread, None if there is none """
+        expires = getattr(self.run_state, 'expires', None)
+        if expires is None:
+            return None
+        return max(0.0, expires - time.monotonic())
+
+    def is_cancelled(self):
+        """ Whether the run of the current thread was cancelled or is past its deadline """
+        cancelled = getattr(self.run_state, 'cancelled', None)
+        return (cancelled is not None and cancelled.is_set()) or self.get_time_left() == 0
+
+    def get_results(self, entry, endpoint=None, shard=None):
+        if shard is None:
+            return self.get_sharded_results(entry, endpoint)
+        if self.get_lookback() > 0:
+            return self.get_lookback_results(entry, endpoint, shard)
+        return self.fetch(entry, endpoint, self.get_query(entry, shard))
+
+    def get_shards(self):
+        """ The shards a query is split into upfront: at least --shards of them (only one, the whole query, by default) """
+        shards = [ ((), True) ]
+        while len(shards) < int(self.get_option('shards', 1) or 1):
+            shards = sum([ self.split_shard(shard) if shard[1] else [ shard ] for shard in shards ], [])
+        return shards
+
+    def split_shard(self, shard):
+        """
+        A shard is (prefix, open): the series whose --shard-label value is made of the character classes of prefix,
+        followed by anything when open. An open shard ending with a class of several characters is split into one
+        shard per character, otherwise into the values that are exactly the prefix and one open shard per
+        SHARD_CLASSES; either way, together they are the same series. A shard that is not open can't be split.
+        """
+        prefix, open = shard
+        if len(prefix) > 0 and len(prefix[-1]) > 1:
+            return [ (prefix[:-1] + (c,), True) for c in prefix[-1] ]
+        return [ (prefix, False) ] + [ (prefix + (c,), True) for c in self.SHARD_CLASSES ]
+
+    @staticmethod
+    def get_shard_regexp(prefix):
+        regexp = ''
+        for c in prefix:
+            if len(c) == 0:
+                regexp += '[^0-9A-Za-z]'
+            elif len(c) == 1:
+                regexp += c
+            else:
+                regexp += '[' + c[0] + '-' + c[-1] + ']'
+        return regexp
+
+    def get_shard_matchers(self, shard):
+        prefix, open = shard
+        if open and len(prefix) == 0:
+            return []
+        # a series missing the label is seen as the empty string, the whole query is still covered
+        return [ self.get_option('shard_label', 'instance') + '=~' + self.promql_string(self.get_shard_regexp(prefix) + ('(?s:.*)' if open else '')) ]
+
+    def format_shard(self, shard):
+        return self.get_shard_regexp(shard[0]) + ('*' if shard[1] else '')
+
+    def get_sharded_results(self, entry, endpoint=None):
+        """
+        The response to the entry's query, split into the shards of get_shards() by the --shard-label label, which are
+        fetched concurrently (--concurrency) and their series concatenated in shard order. A shard failing with one of
+        the SIZE_ERRORS (too many samples for Prometheus, or a body too large for a proxy) is split further, and its
+        parts take its place, up to --max-shards shards: past that, the query fails with the error of the whole query.
+        The series come back in another order than without shards.
+        """
+        endpoint = self.get_endpoint(endpoint)
+        cachekey = (endpoint['url'], 'shards', self.get_query(entry))
+        if cachekey in self.CACHE:
+            return self.CACHE[cachekey]
+        shards = self.get_shards()
+        maxshards = max(int(self.get_option('max_shards', 256)), len(shards))
+        first = None
+        if len(shards) == 1:
+            rj = first = self.get_results(entry, endpoint, shards[0])
+            if not self.is_size_error(rj):
+                return rj
+            self.debug(1, ' [get_results] %s: %s, splitting it by %s', entry['metric'], rj['status'], self.get_option('shard_label', 'instance'))
+            shards = self.split_shard(shards[0])
+        results = {}
+        pending = list(shards)
+        with ThreadPoolExecutor(max_workers=max(1, int(self.get_option('concurrency', 4))), initializer=self.set_run_state,
+                                initargs=self.get_run_state()) as executor:
+            while len(pending) > 0:
+                futures = [ (shard, executor.submit(self.get_results, entry, endpoint, shard)) for shard in pending ]
+                pending = []
+                for shard, future in futures:
+                    rj = future.result()
+                    if self.is_size_error(rj) and shard[1]:
+                        parts = self.split_shard(shard)
+                        if len(shards) - 1 + len(parts) > maxshards:
+                            self.debug(1, ' [get_results] %s: still too large in %d shards, giving up', entry['metric'], len(shards))
+                            return first if first is not None else rj
+                        self.debug(1, ' [get_results] %s shard %s: %s, splitting it', entry['metric'], self.format_shard(shard), rj['status'])
+                        i = shards.index(shard)
+                        shards[i:i + 1] = parts
+                        pending += parts
+                    elif rj['status'] != 'success':
+                        return rj
+                    else:
+                        results[shard] = rj
+        result = []
+        for shard in shards:
+            result += results[shard]['data']['result']
+            # the merged result replaces the shards'
+            if self.get_lookback() > 0:
+                self.CACHE.pop((endpoint['url'], tuple(self.get_lookback_queries(entry, shard))), None)
+            else:
+                self.CACHE.pop((endpoint['url'], self.get_query(entry, shard)), None)
+        self.debug(2, ' [get_results] %s: %d series from %d shards', entry['metric'], len(result), len(shards))
+        self.CACHE[cachekey] = {'status': 'success', 'data': {'resultType': 'vector', 'result': result}}
+        return self.CACHE[cachekey]
+
+    def is_size_error(self, rj):
+        """ Whether a failed response says the query is too large, so that its shards may not be """
+        if rj['status'] not in self.SIZE_ERRORS:
+            return False
+        return rj['status'] != 'http code: 422' or self.SIZE_ERROR_MESSAGES.search(rj.get('error', '')) is not None
+
+    def get_lookback_results(self, entry, endpoint=None, shard=None):
+        """
+        get_results() with --lookback: the series seen in any of the windows of get_lookback_queries(), each with the
+        time it was last seen as value (in the order they were first found, newest window first)
+        """
+        endpoint = self.get_endpoint(endpoint)
+        queries = self.get_lookback_queries(entry, shard)
+        cachekey = (endpoint['url'], tuple(queries))
+        if cachekey in self.CACHE:
+            return self.CACHE[cachekey]
+        # series are told apart by their labels and, when several share the same (e.g. only some labels were kept by
+        # --stream), by their position among them within a window
+        seen = {}
+        order = []
+        for query in queries:
+            rj = self.fetch(entry, endpoint, query)
+            if rj['status'] != 'success':
+                return rj
+            # the merged result replaces the windows'
+            self.CACHE.pop((endpoint['url'], query), None)
+            occurrences = {}
+            for row in rj['data']['result']:
+                key = tuple(sorted(row['metric'].items()))
+                n = occurrences.get(key, 0)
+                occurrences[key] = n + 1
+                rows = seen.setdefault(key, [])
+                if n >= len(rows):
+                    rows += [ row ]
+                    order += [ (key, n) ]
+                elif float(row['value'][1]) > float(rows[n]['value'][1]):
+                    rows[n] = dict(rows[n], value=row['value'])
+        result = [ seen[key][n] for key, n in order ]
+        self.CACHE[cachekey] = {'status': 'success', 'data': {'resultType': 'vector', 'result': result}}
+        return self.CACHE[cachekey]
+
+    def fetch(self, entry, endpoint=None, query=None):
+        """ The response to query (by default, the one planned for the entry's metric), cached per endpoint """
+        endpoint = self.get_endpoint(endpoint)
+        # results are cached per endpoint, so that collecting from several endpoints cannot mix them
+        if query is None:
+            query = self.get_query(entry)
+        cachekey = (endpoint['url'], query)
+        if cachekey in self.CACHE:
+            self.debug(2, ' [get_results] returning cached results for: %s from %s', entry['metric'], endpoint['url'])
+            return self.CACHE[cachekey]
+        if cachekey in self.FAILED_QUERIES:
+            self.debug(2, ' [get_results] %s already failed on %s: %s', entry['metric'], endpoint['url'], self.FAILED_QUERIES[cachekey]['status'])
+            return dict(self.FAILED_QUERIES[cachekey])
+        start = time.time()
+        stream = self.get_option('stream', False)
+        r = None
+        # of any age: if the query fails, expired results are used rather than none
+        path = self.get_disk_cache(endpoint, query, expired=True)
+        fresh = path is not None and (self.get_option('offline', False) or self.is_disk_cache_fresh(path))
+        # --offline wins over --refresh: there's nothing to refresh from
+        if fresh and (self.get_option('offline', False) or not self.get_option('refresh', False)):
+            self.debug(2, ' [get_results] returning results from disk cache for: %s from %s', entry['metric'], endpoint['url'])
+        elif self.get_option('offline', False):
+            return {'status': 'offline: no cached results'}
+        elif self.is_cancelled():
+            return {'status': 'cancelled'}
         else:
-            r = requests.get(uri, verify=False)
-        if r.status_code != 200:
-            return {'status': 'http code: ' + str(r.status_code)}
-        self.CACHE[entry['metric']] = json.loads(r.content.decode('UTF-8'))
-        return self.CACHE[entry['metric']]
+            import requests
+            uri = self.get_uri(entry, endpoint, query)
+            self.debug(2, ' [get_results] querying: %s', uri)
+            try:
+                r = self.get_session().get(uri, timeout=self.get_timeout(), auth=endpoint['auth'], stream=stream)
+                status = 'http code: ' + str(r.status_code)
+            except requests.exceptions.RequestException as e:
+                status = 'request failed: ' + str(e)
+            if r is None or r.status_code != 200:
+                self.debug(2, ' [get_results] %s %s after %.3fs', entry['metric'], status, time.time() - start)
+                failure = {'status': status}
+                if r is not None:
+                    failure.update(self.get_error_details(r))
+                    r.close()
+                if path is None:
+                    # not sent again during this run, by process() or other rules
+                    self.FAILED_QUERIES[cachekey] = failure
+                    return dict(failure)
+                # better a day old inventory than none at all
+                self.debug(1, ' [get_results] %s %s, using expired results from disk cache', entry['metric'], status)
+                r = None
+
+        if stream:
+            counter = [ 0 ]
+            rj = None
+            if r is not None:
+                chunks = self.tee_disk_cache(endpoint, query, r.iter_content(chunk_size=65536))
+                try:
+                    rj = self.decode_stream(chunks, self.REQUIRED.get(entry['metric']), query in self.PROJECTED, counter, self.get_lookback() > 0)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    # the body is read while decoded: the connection can break (or the body end) half way
+                    status = 'request failed: ' + str(e)
+                chunks.close()
+                r.close()
+                self.commit_disk_cache(endpoint, query, rj is not None and rj.get('status') == 'success')
+                if rj is None:
+                    self.debug(2, ' [get_results] %s %s after %.3fs', entry['metric'], status, time.time() - start)
+                    if path is None:
+                        self.FAILED_QUERIES[cachekey] = {'status': status}
+                        return {'status': status}
+                    self.debug(1, ' [get_results] %s %s, using expired results from disk cache', entry['metric'], status)
+                    counter = [ 0 ]
+            if rj is None:
+                rj = self.decode_stream(self.read_chunks(path), self.REQUIRED.get(entry['metric']), query in self.PROJECTED, counter, self.get_lookback() > 0)
+            size, elapsed = counter[0], time.time() - start
+        else:
+            if r is not None:
+                content = r.content
+            else:
+                with open(path, 'rb') as f:
+                    content = f.read()
+            elapsed = time.time() - start
+            rj = json.loads(content.decode('UTF-8'))
+            if r is not None and rj.get('status') == 'success':
+                self.set_disk_cache(endpoint, query, content)
+            if query in self.PROJECTED:
+                rj = self.expand_counts(rj)
+            size = len(content)
+        decoded = time.time() - start
+        self.CACHE[cachekey] = rj
+        self.debug(2, ' [get_results] %s: %d bytes, http %.3fs, decode %.3fs', entry['metric'], size, elapsed, decoded - elapsed)
+        if self.PROFILE is not None:
+            self.profile_query(entry['metric'], elapsed, size, decoded - elapsed)
+        return self.CACHE[cachekey]
+
+    @staticmethod
+    def get_error_details(r):
+        """ The errorType and error of a failed Prometheus response, if its body has them """
+        import requests
+        try:
+            rj = r.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return {}
+        if not isinstance(rj, dict):
+            return {}
+        return dict([ (key, str(rj[key])) for key in [ 'errorType', 'error' ] if key in rj ])
+
+    @staticmethod
+    def read_chunks(path, size=65536):
+        with open(path, 'rb') as f:
+            chunk = f.read(size)
+            while chunk:
+                yield chunk
+                chunk = f.read(size)
+
+    @staticmethod
+    def iter_stream(chunks, envelope):
+        """
+        Parses a Prometheus query response given as an iterable of bytes, yielding the entries of data.result one by
+        one as soon as they are complete, so the whole document never has to be in memory. The rest of the document
+        (status, data.resultType, ...) is put into envelope once the last chunk is parsed.
+        """
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('UTF-8')()
+        head = []
+        buf = ''
+        inresult = False
+        for chunk in chunks:
+            buf += utf8.decode(chunk)
+            if not inresult:
+                found = re.search(r'"result"\s*:\s*\[', buf)
+                if not found:
+                    continue
+                head += [ buf[:found.start()] ]
+                buf = buf[found.end():]
+                inresult = True
+            if inresult is True:
+                pos = 0
+                while True:
+                    while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                        pos += 1
+                    if pos >= len(buf):
+                        break
+                    if buf[pos] == ']':
+                        inresult = None
+                        break
+                    try:
+                        item, pos = decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        # incomplete, wait for the next chunk
+                        break
+                    yield item
+                buf = buf[pos:]
+        buf += utf8.decode(b'', final=True)
+        if inresult is True:
+            raise ValueError('truncated response')
+        if inresult is False:
+            envelope.update(json.loads(buf))
+        else:
+            envelope.update(json.loads(''.join(head) + '"result": [' + buf))
+
+    def decode_stream(self, chunks, labels=None, counted=False, counter=None, values=False):
+        """
+        Decodes a response with iter_stream(), keeping of each series only the given labels (all if None), as
+        interned strings, and dropping the sample value (or using it to expand the series of a projected query),
+        unless values is set
+        """
+        if counter is not None:
+            chunks = self.count_chunks(chunks, counter)
+        rj = {}
+        result = []
+        for row in self.iter_stream(chunks, rj):
+            metric = row['metric']
+            compact = { sys.intern(l): sys.intern(v) for l, v in metric.items() if labels is None or l in labels }
+            if counted:
+                result += [ {'metric': compact} ] * int(float(row['value'][1]))
+            elif values:
+                result += [ {'metric': compact, 'value': row['value']} ]
+            else:
+                result += [ {'metric': compact} ]
+        if rj.get('status') == 'success':
+            rj['data']['result'] = result
+        return rj
+
+    @staticmethod
+    def count_chunks(chunks, counter):
+        for chunk in chunks:
+            counter[0] += len(chunk)
+            yield chunk
+
+    def get_disk_cache_path(self, endpoint, query):
+        """
+        Where the results of query on endpoint are kept in --cache-dir: <cache-dir>/<endpoint>/<metric>.json, as
+        raw Prometheus responses (the same as the tests/data fixtures). Queries other than a bare metric name get a
+        hash of the query appended to the metric name.
+        """
+        epdir = re.sub(r'[^a-zA-Z0-9_.-]+', '_', re.sub(r'^[a-z]+://', '', endpoint['url']))
+        name = query
+        if not re.match(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$', query):
+            metric = re.search(r'[a-zA-Z_:][a-zA-Z0-9_:]*(?=\s*(\{|\)|$))', query)
+            name = (metric.group(0) if metric else 'query') + '-' + hashlib.sha1(query.encode('UTF-8')).hexdigest()[:16]
+        return os.path.join(self.get_option('cache_dir'), epdir, name + '.json')
+
+    def get_disk_cache(self, endpoint, query, expired=False):
+        """
+        The path to the cached response to query, if there's one younger than --cache-ttl (or any age, with expired)
+        """
+        if not self.get_option('cache_dir'):
+            return None
+        path = self.get_disk_cache_path(endpoint, query)
+        if not os.path.exists(path):
+            return None
+        if not expired and not self.is_disk_cache_fresh(path):
+            return None
+        return path
+
+    def is_disk_cache_fresh(self, path):
+        """ Whether the cached response at path is younger than --cache-ttl """
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return False
+        if age > float(self.get_option('cache_ttl', 86400)):
+            self.debug(2, ' [get_disk_cache] %s expired %ds ago', path, age - float(self.get_option('cache_ttl', 86400)))
+            return False
+        return True
+
+    def get_disk_cache_tmppath(self, endpoint, query):
+        return self.get_disk_cache_path(endpoint, query) + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+
+    def set_disk_cache(self, endpoint, query, content):
+        self.commit_disk_cache(endpoint, query, True, self.tee_disk_cache(endpoint, query, [ content ]))
+
+    def tee_disk_cache(self, endpoint, query, chunks):
+        """ Passes chunks through, writing them to a temporary file to be kept by commit_disk_cache() """
+        if not self.get_option('cache_dir') or self.get_option('offline', False):
+            for chunk in chunks:
+                yield chunk
+            return
+        tmppath = self.get_disk_cache_tmppath(endpoint, query)
+        os.makedirs(os.path.dirname(tmppath), exist_ok=True)
+        with open(tmppath, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+
+    def commit_disk_cache(self, endpoint, query, keep, chunks=()):
+        for chunk in chunks:
+            pass
+        if not self.get_option('cache_dir'):
+            return
+        tmppath = self.get_disk_cache_tmppath(endpoint, query)
+        if not os.path.exists(tmppath):
+            return
+        if keep:
+            os.replace(tmppath, self.get_disk_cache_path(endpoint, query))
+            self.disk_cache_written = True
+        else:
+            os.unlink(tmppath)
+
+    def evict_disk_cache(self):
+        """
+        Removes the least recently written results until the cache fits in --cache-max-size (MB). Called once per run
+        by finish(), so the cache can go over the limit by the results of a run. The compiled rules file is kept.
+        """
+        maxsize = float(self.get_option('cache_max_size', 1024)) * 1024 * 1024
+        root = self.get_option('cache_dir')
+        with self.cache_lock:
+            self.disk_cache_written = False
+            files = []
+            for dirpath, dirnames, filenames in os.walk(root):
+                # results are in a folder per endpoint, the compiled rules file (see get_config_cache_path()) at the top
+                if dirpath == root:
+                    continue
+                for filename in filenames:
+                    if filename.endswith('.json'):
+                        try:
+                            st = os.stat(os.path.join(dirpath, filename))
+                        except OSError:
+                            continue
+                        files += [ (st.st_mtime, st.st_size, os.path.join(dirpath, filename)) ]
+            total = sum([ size for mtime, size, path in files ])
+            for mtime, size, path in sorted(files):
+                if total <= maxsize:
+                    break
+                self.debug(2, ' [evict_disk_cache] removing %s', path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def get_prefetch_entries(self, rules):
+        """
+        Returns one entry per distinct metric needed by the rules, including the metrics they join with
+        """
+        entries = {}
+        for m in rules:
+            for entry in (m, ) + m.join:
+                if entry['metric'] not in entries:
+                    entries[entry['metric']] = entry
+        return list(entries.values())
+
+    def prefetch(self, rules, endpoints=None):
+        """
+        Fills the CACHE by querying all metrics needed by the rules, on all endpoints, concurrently, so that
+        process() only has to deal with cached results. Failed queries are kept in FAILED_QUERIES, for process() to
+        report them without sending them again.
+        """
+        if endpoints is None:
+            endpoints = [ self.get_endpoint() ]
+        entries = self.get_prefetch_entries(rules)
+        queries = [ (batch, ep) for ep in endpoints for batch in self.get_batches(entries, ep) ]
+        concurrency = max(1, int(self.get_option('concurrency', 4)))
+        self.debug(1, '[prefetch] running %d queries with concurrency=%d', len(queries), concurrency)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [ executor.submit(self.prefetch_batch, batch, ep) for batch, ep in queries ]
+            for future in futures:
+                future.result()
+        self.debug(1, '[prefetch] done in %.3fs', time.time() - start)
+
+    def prefetch_batch(self, entries, endpoint):
+        """ Queries the entries of a batch of get_batches() at once, or one by one if that fails, returns [ (entry, response) ] """
+        if len(entries) > 1:
+            rj = self.get_batch_results(entries, endpoint)
+            if rj['status'] != 'success':
+                self.debug(1, '[prefetch] batch query failed for metrics [%s] on %s: %s, querying them one by one',
+                           ','.join([ entry['metric'] for entry in entries ]), endpoint['url'], rj['status'])
+        results = [ (entry, self.get_results(entry, endpoint)) for entry in entries ]
+        for entry, rj in results:
+            if rj['status'] != 'success':
+                self.debug(1, '[prefetch] query failed for metric [%s] on %s: %s', entry['metric'], endpoint['url'], rj['status'])
+        return results
+
+    def get_batches(self, entries, endpoint):
+        """
+        Splits the entries into batches to be queried at once (with --batch-queries, one entry per batch otherwise):
+        the metrics queried with the same label matchers, and either all projected or none, up to --batch-max-series
+        series per batch as counted by count_series(). Metrics already cached, or too large, are left on their own.
+        """
+        if not self.get_option('batch_queries', False) or self.get_lookback() > 0 or self.get_option('offline', False):
+            return [ [ entry ] for entry in entries ]
+        batches = []
+        groups = {}
+        for entry in entries:
+            metric = entry['metric']
+            if (endpoint['url'], self.get_query(entry)) in self.CACHE or self.get_disk_cache(endpoint, self.get_query(entry)) is not None:
+                batches += [ [ entry ] ]
+            else:
+                groups.setdefault((tuple(self.SELECTORS.get(metric, [])), metric in self.PROJECTIONS), []).append(entry)
+        counts = {}
+        if len(groups) > 0:
+            counts = self.count_series(sum(groups.values(), []), endpoint)
+        maxseries = int(self.get_option('batch_max_series', 10000))
+        for group in groups.values():
+            batch = []
+            size = 0
+            for entry in group:
+                # unknown if the count failed: better one query per metric than a batch too large
+                count = counts.get(entry['metric'], 0) if counts is not None else maxseries + 1
+                if count > maxseries:
+                    batches += [ [ entry ] ]
+                    continue
+                if size + count > maxseries:
+                    batches += [ batch ]
+                    batch = []
+                    size = 0
+                batch += [ entry ]
+                size += count
+            if len(batch) > 0:
+                batches += [ batch ]
+        return batches
+
+    def get_name_matcher(self, entries):
+        return '__name__=~' + self.promql_string('|'.join([ self.promql_escape(entry['metric']) for entry in entries ]))
+
+    def count_series(self, entries, endpoint):
+        """ How many series each metric of entries has (without matchers, so an estimate on the high side), or None """
+        import requests
+        if self.is_cancelled():
+            return None
+        query = 'count by (__name__) ({' + self.get_name_matcher(entries) + '})'
+        try:
+            r = self.get_session().get(self.get_uri(None, endpoint, query), timeout=self.get_timeout(), auth=endpoint['auth'])
+            rj = r.json() if r.status_code == 200 else {'status': 'http code: ' + str(r.status_code)}
+        except (requests.exceptions.RequestException, ValueError) as e:
+            rj = {'status': 'request failed: ' + str(e)}
+        if rj.get('status') != 'success':
+            self.debug(1, '[prefetch] counting series failed on %s: %s', endpoint['url'], rj['status'])
+            return None
+        return dict([ (s['metric'].get('__name__', ''), int(float(s['value'][1]))) for s in rj['data']['result'] ])
+
+    def get_batch_results(self, entries, endpoint):
+        """
+        Queries the metrics of entries at once, as {__name__=~"<metric>|<metric>|..."} with their common matchers, and
+        puts the series of each metric into the CACHE as if it had been queried alone (with --stream or
+        --project-labels, they only keep the labels its own query would have returned). Nothing is cached on failure.
+        """
+        endpoint = self.get_endpoint(endpoint)
+        metrics = [ entry['metric'] for entry in entries ]
+        # the batch is a metric of its own for fetch(), its profile and debug
+        batch = {'metric': '|'.join(metrics)}
+        if all([ metric in self.REQUIRED for metric in metrics ]):
+            self.REQUIRED[batch['metric']] = frozenset(['__name__']).union(*[ self.REQUIRED[metric] for metric in metrics ])
+        if metrics[0] in self.PROJECTIONS:
+            self.PROJECTIONS[batch['metric']] = sorted(self.REQUIRED[batch['metric']])
+        query = self.build_query(batch['metric'], [ self.get_name_matcher(entries) ] + self.SELECTORS.get(metrics[0], []))
+        rj = self.fetch(batch, endpoint, query)
+        if rj['status'] != 'success':
+            return rj
+        self.CACHE.pop((endpoint['url'], query), None)
+        results = dict([ (metric, []) for metric in metrics ])
+        trim = self.get_option('stream', False) or metrics[0] in self.PROJECTIONS
+        for row in rj['data']['result']:
+            metric = row['metric'].get('__name__')
+            if metric not in results:
+                continue
+            if trim and metric in self.REQUIRED:
+                row = dict(row, metric=dict([ (l, v) for l, v in row['metric'].items() if l in self.REQUIRED[metric] ]))
+            results[metric] += [ row ]
+        for entry in entries:
+            self.CACHE[(endpoint['url'], self.get_query(entry))] = {'status': 'success', 'data': {'resultType': 'vector', 'result': results[entry['metric']]}}
+        self.debug(2, '[prefetch] %d series of %d metrics in one query', len(rj['data']['result']), len(metrics))
+        return rj
 
     """
     row will contain, among the "data" that we're looking for, also some metafields that should be locatable via
@@ -170,149 +1325,211 @@ class PrometheusInventory:
     map/dict of "the index fields concatenated by '-'" and the respective value.
     This is so we can support multiple index fields, for precise correlation.
     
-    The actual gathering of the values happens with lookupstmp, where the index fields are acquired by extending the 
+    The actual gathering of the values happens in get_lookup(), where the index fields are acquired by extending the
     labels definition with our own private mapping, by injecting labels such as '_index_' + index (for each index field).
     This way we preserve those values after process() is called, to be used in the reordering afterwards.
+    The compiled joins already carry those labels, see compile_rule().
     """
-    def build_lookups(self, m):
-        lookupstmp = {}
-        for join in m['join']:
-            self.debug(3, '  [build_lookups] for: ' + join['metric'] + ' using index: ' + str(join['index']))
-            self.complete_with_defaults(join)
-            # pushdown filters?
-            join['ignore_regexp'] += m['ignore_regexp']
-
-            skip_fields = ['extra']
-            for idx in join['index']:
-                # Because we'll be using process() to collect this metric, we need to make sure that the 'index' fields
-                # are preserved (so we can use them later)
-                join['labels']['_index_' + idx] = idx
-                skip_fields += ['_index_' + idx]
-            #self.debug(3, 'join = ' + str(join))
-            #self.debug(3, "join['labels']['__index__'] = join['index'] = " + str(join['index']))
-            for field in join['labels'].keys():
-                if field in skip_fields:
-                    continue
-                lookupstmp[field] = []
-                self.process(join, lookupstmp[field])
-                self.debug(3, '  [build_lookups] this lookup (' + field + ') has ' + str(len(lookupstmp[field])) + ' elements.')
-        self.debug(3,'lookupstmp = ')
-        self.debug_var(3, lookupstmp)
-
-        #self.debug(2, 'm[join] = ')
-        #self.debug_var(2, m['join'])
-
-        # reorganize lookups by 'index'
+    def build_lookups(self, m, endpoint=None):
         lookups = {}
-        for join in m['join']:
-            self.debug(3, '  [build_lookups] reindexing: ' + join['metric'])
-            for field in join['labels']:
-                if field in skip_fields:
-                    continue
-                self.debug(3, 'field is relevant in join[labels]=' + field)
-                lookups[field] = { 'index': join['index'], 'metric': join['metric'], 'data': {} }
-                for row in lookupstmp[field]:
-                    if field in row:
-                        lookups[field]['data'][ self.__gen_index_key(row, join['index']) ] = row[field]
-                    else:
-                        lookups[field]['data'][ self.__gen_index_key(row, join['index']) ] = ''
-        del lookupstmp
+        for join in m.join:
+            self.debug(3, '  [build_lookups] for: %s using index: %s', join.metric, join.index)
+            data = self.get_lookup(join, endpoint)
+            for field in join.fields:
+                self.debug(3, '  [build_lookups] this lookup (%s) has %d elements.', field, len(data[field]))
+                lookups[field] = { 'index': join.index, 'metric': join.metric, 'data': data[field] }
         return lookups
 
+    def get_lookup(self, join, endpoint=None):
+        """
+        Builds, in a single pass over the join results, the map of index key -> value for each of the join fields.
+        Joins are compiled with the ignore rules of their parent, so identical joins of rules with the same ignore
+        rules share the same lookups (they are not meant to be modified).
+        """
+        cachekey = (self.get_endpoint(endpoint)['url'], join.signature, self.options.hide_ignored)
+        if cachekey in self.LOOKUPS:
+            self.debug(3, '  [get_lookup] reusing lookups for: %s', join.metric)
+            return self.LOOKUPS[cachekey]
+        rows = InventoryDB()
+        failed = self.process(join, rows, endpoint) is None
+        data = { field: {} for field in join.fields }
+        for row in rows:
+            key = self.__gen_index_key(row, join.index)
+            for field in join.fields:
+                data[field][key] = row.get(field, '')
+        self.debug(3, '  [get_lookup] lookups for %s = ', join.metric)
+        self.debug_var(3, data)
+        if not failed:
+            # a failed join is tried (and reported) again by each rule using it
+            self.LOOKUPS[cachekey] = data
+        return data
+
+
+    def process(self, m, targetDB, endpoint=None):
+        """ Pushes the rows of rule (or join) m into targetDB, returns True, or None (reported) if a query failed """
+        if isinstance(m, dict):
+            m = self.compile_rule(m)
+        fetched = self.get_rule_results(m, endpoint)
+        if fetched is None:
+            return None
+        lookups, result = fetched
+        rows = self.process_rows(m, result, lookups, endpoint)
+        if self.PROFILE is not None:
+            self.push_rows_profiled(m, rows, len(result), targetDB)
+            return True
+        for irow in rows:
+            self.push_row(irow, targetDB)
+        return True
 
-    def process(self, m, targetDB):
-        self.debug(1, '[process] processing entry=' + m['metric'] + ", labels=" + str(m['labels']))
+    def get_rule_results(self, m, endpoint=None):
+        """
+        The lookups of the joins of rule m, and the result of its query, or None (reported) if the query failed
+        """
+        if m.name is not None:
+            # joins are processed on behalf of this rule, see get_profile_stats()
+            self.current_rule = m.name
+        self.debug(1, '[process] processing entry=%s, labels=%s', m.metric, m.config['labels'])
 
         # First, we get the metrics to join, so we can use them as lookups
-        lookups = self.build_lookups(m)
+        lookups = self.build_lookups(m, endpoint)
         self.debug(3,'lookups = ')
         self.debug_var(3, lookups)
 
-        """ We need to preserve, in the main metric, all index fields we find in joins, so that we can use them later
-        to correlate with the lookups, so let's inject them in the same form
-        """
-#        idxfields = []
-#        for join in m['join']:
-#            idxfields += join['index']
-#        idxfields = list(set(idxfields))
-#        self.debug(3, 'injecting index fields as labels to preserve from the metric: ' + str(idxfields))
-#        for idxfield in idxfields:
-#            m['labels'].update({'_index_' + idxfield: idxfield } )
-#        self.debug(3, 'now m.labels looks like: ' + str(m['labels']))
-
-        rj = self.get_results(m)
+        rj = self.get_results(m, endpoint)
         #self.debug_var(2, rj)
 
         if rj['status'] != 'success':
-            self.error('Prometheus query failed for metric [' + m['metric'] + ']: ' + rj['status'])
+            self.error('Prometheus query failed for metric [' + m.metric + ']: ' + rj['status'])
+            self.FAILURES[m.metric] = self.FAILURES.get(m.metric, 0) + 1
             return None
-        for row in rj['data']['result']:
-            #self.debug_var(2, row['metric'])
-            #self.debug_var(2, m['labels'])
-            irow = { 'type': m['type'], 'brand':'', 'model':'', 'serial':'', 'location':'', 'extra': [], 'sources': [ m['metric'] ], 'collisions': m['collisions']}
+        return lookups, rj['data']['result']
+
+    def push_rows_profiled(self, m, rows, rows_in, targetDB):
+        """ The end of process() with --profile: the same, counting rows and timing push_row() """
+        stats = self.get_profile_stats(m)
+        start = time.perf_counter()
+        before = len(targetDB)
+        emitted, ignored, pushing = 0, 0, 0.0
+        for irow in rows:
+            emitted += 1
+            if 'ignored' in irow:
+                ignored += 1
+            t = time.perf_counter()
+            self.push_row(irow, targetDB)
+            pushing += time.perf_counter() - t
+        stats['rows_in'] += rows_in
+        stats['rows_ignored'] += ignored + rows_in - emitted
+        stats['rows_emitted'] += emitted
+        stats['collisions_merged'] += emitted - (len(targetDB) - before)
+        stats['push_row'] += pushing
+        stats['process'] += time.perf_counter() - start - pushing
+
+    def process_parallel(self, rules, endpoints, workers):
+        """
+        Processes the rules (on each endpoint) in a pool of worker processes, started (forkserver, or spawn) once the
+        results are prefetched. The results and lookups of each rule are read here (get_rule_results(), reporting
+        failed queries) and sent to a worker, which only turns them into rows (process_rows()); their rows are pushed
+        into the DB here, in the same order as a serial run, so collisions are merged exactly the same way. Returns a
+        RuleResult per rule and endpoint, as process_rule() would.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        results = []
+        self.debug(1, '[process_parallel] %d rules on %d endpoints with %d workers', len(rules), len(endpoints), workers)
+        # workers don't inherit the threads, sockets or event loop of this process (as forked ones would)
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        tasks, errors = [], []
+        for ep, m in [ (ep, m) for ep in endpoints for m in rules ]:
+            previous, self.last_error = self.last_error, None
+            fetched = self.get_rule_results(m, ep)
+            error, self.last_error = self.last_error, self.last_error or previous
+            tasks += [ (m, fetched[1], fetched[0], ep) if fetched is not None else None ]
+            errors += [ error ]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                                 initializer=init_worker, initargs=(self.options, self.federated)) as executor:
+            processed = executor.map(process_task, [ task for task in tasks if task is not None ])
+            for (ep, m), task, error in zip([ (ep, m) for ep in endpoints for m in rules ], tasks, errors):
+                if error is not None:
+                    self.set_rule_error(m, ep, error)
+                before = len(self.DB)
+                if task is not None:
+                    rows, elapsed = next(processed)
+                    if self.PROFILE is not None:
+                        self.current_rule = m.name
+                        self.push_rows_profiled(m, rows, len(task[1]), self.DB)
+                        self.get_profile_stats(m)['process'] += elapsed
+                    else:
+                        for irow in rows:
+                            self.push_row(irow, self.DB)
+                results += [ RuleResult(m.name, ep['url'], self.DB[before:], error) ]
+        return results
+
+    def process_rows(self, m, result, lookups, endpoint=None):
+        """
+        Turns each series of the query result into a DB row, according to the compiled rule m
+        """
+        debug4 = self.getDebug() >= 4
+        hide_ignored = self.options.hide_ignored
+        lookback = self.get_lookback() > 0
+        for row in result:
+            labels = row['metric']
+            irow = InventoryRecord(m.type, m.collisions)
+            sources = [ m.metric ]
+            if lookback:
+                # see get_lookback_results()
+                irow['last_seen'] = int(float(row['value'][1]))
 
             # Inject the lookups as original metric's labels, so we can refer to them as if they were there from the beginning.
             # This allows for lookup data to be injected as 'extra' (this field is ignored during lookups building, which makes it
             # impossible to be passed in join[].label)
-            for field in lookups:
-                index = lookups[field]['index']
-                self.debug(4, 'checking field: ' + field + ', joining_row: ' + str(row))
-                #self.debug_var(2, lookups[field]['data'])
-
-                rowidx = self.__gen_index_key(row['metric'], lookups[field]['index'], '')
-                if rowidx in lookups[field]['data']:
-                    row['metric'][field] = lookups[field]['data'][rowidx]
-                    irow['sources'] += [lookups[field]['metric']]
-
-            for l in row['metric']:
-                for tl, tv in m['labels'].items():
-                    if (tl != 'extra') and (type(tv) is list):
-                        for tv2 in tv:
-                            if l == tv2:
-                                irow[tl] = row['metric'][l]
-                    else:
-                        if (tl != 'extra') and (l == tv):
-                            #self.debug(2, ' + matched: ' + tl + ' = ' + row['metric'][l])
-                            irow[tl] = row['metric'][l].strip()
-                if l in m['labels']['extra']:
-                    irow['extra'] += [ row['metric'][l] ]
+            if lookups:
+                # don't touch the cached results, they may be shared with other rules
+                labels = dict(labels)
+                for field in lookups:
+                    if debug4:
+                        self.debug(4, 'checking field: %s, joining_row: %s', field, row)
+                    rowidx = self.__gen_index_key(labels, lookups[field]['index'], '')
+                    if rowidx in lookups[field]['data']:
+                        labels[field] = lookups[field]['data'][rowidx]
+                        sources += [lookups[field]['metric']]
 
+            for l, v in labels.items():
+                for tl, strip in m.labelmap.get(l, ()):
+                    irow[tl] = v.strip() if strip else v
+                if l in m.extra:
+                    irow.extra.append(v)
 
-            #self.debug(3, "regexp = " + str(m['regexp']))
-            for f, exp in m['regexp'].items():
-                if f in row['metric']:
-                    r = re.match(exp, row['metric'][f] )
+            for f, exp in m.regexp:
+                if f in labels:
+                    r = exp.match(labels[f])
                     if r:
                         for lk, lv in r.groupdict().items():
                             irow[lk] = lv
-            for f, v in m['static'].items():
+            for f, v in m.static:
                 irow[f] = v
 
-            if self.check_if_ignore(row, m):
-                if self.options.hide_ignored:
+            if self.check_if_ignore(labels, m):
+                if debug4:
+                    self.debug(4, '   [check_if_ignore] ignrule matched: %s', labels)
+                if hide_ignored:
                     continue
-                irow['extra'] += [ 'ignored' ]
+                irow.extra.append('ignored')
                 irow['ignored'] = True
-#            else:
-#                for field in lookups:
-#                    if field in ['__index__']:
-#                        continue
-#                    index = lookups[field]['index']
-#                    #self.debug(2, 'checking field: ' + field + ', joining_row: ' + str(row))
-#                    #self.debug_var(2, lookups[field]['data'])
-#                    if row['metric'][index] in lookups[field]['data']:
-#                        if isinstance(irow[field], list):
-#                            irow[field] += [ lookups[field]['data'][ row['metric'][index] ] ]
-#                        else:
-#                            irow[field] = lookups[field]['data'][ row['metric'][index] ]
 
             # for non-recursive (ie, parent entries), log the source entry (for debugging)
-            if 'name' in m:
-                irow['sources'].insert(0, m['name'])
-            self.push_row(irow, targetDB)
+            if m.name is not None:
+                sources.insert(0, m.name)
+                # when collecting from several endpoints, also log where the entry came from
+                if endpoint is not None and self.federated:
+                    sources += [ endpoint['url'] ]
+            irow['sources'] = sources
+            yield irow
 
     def complete_with_defaults(self, m):
-        m['ignored'] = False
+        """
+        Returns a copy of the rule m with the optional settings filled in
+        """
+        m = dict(m)
         if not 'collisions' in m:
             m['collisions'] = 'override'
         if not 'static' in m:
@@ -322,72 +1539,848 @@ class PrometheusInventory:
         if not 'ignore_regexp' in m:
             m['ignore_regexp'] = []
         # following are required: type, labels
+        m['labels'] = dict(m['labels'])
         if not 'extra' in m['labels']:
             m['labels']['extra'] = [ ]
         if not 'join' in m:
-            m['join'] = {}
+            m['join'] = []
         # added to support join/lookups
         if not 'type' in m:
             m['type'] = 'unknown'
+        return m
+
+    def compile_rule(self, m, parent=None):
+        """
+        Compiles a rule from the rules file (or, with parent, one of its joins) into a CompiledRule, so that processing
+        the results does no regexp parsing nor config lookups per row:
+        - regexp and ignore_regexp are compiled, ignore_regexp flattened into (label, regexp or None) pairs;
+        - labels are inverted into a map of metric label -> fields it fills in, in the order they are assigned;
+        - joins get the labels that preserve their index fields, and the ignore rules of their parent.
+        """
+        m = self.complete_with_defaults(m)
+        labels = m['labels']
+        index = tuple(m.get('index', []))
+        skip_fields = [ 'extra' ]
+        if parent is not None:
+            for idx in index:
+                # Because we'll be using process() to collect this metric, we need to make sure that the 'index' fields
+                # are preserved (so we can use them later)
+                labels['_index_' + idx] = idx
+                skip_fields += ['_index_' + idx]
+
+        labelmap = {}
+        for field, label in labels.items():
+            if field == 'extra':
+                continue
+            if type(label) is list:
+                for l in label:
+                    labelmap.setdefault(l, []).append( (field, False) )
+            else:
+                labelmap.setdefault(label, []).append( (field, True) )
+        extra = labels['extra'] or []
+        if isinstance(extra, list):
+            extra = frozenset(extra)
+
+        ignore = []
+        for ignrule in m['ignore_regexp']:
+            for ignfield, ignexp in ignrule.items():
+                ignore += [ (ignfield, re.compile(ignexp) if ignexp else None) ]
+        if parent is not None:
+            # pushdown filters
+            ignore += parent.ignore
+
+        rule = CompiledRule(
+            name=m.get('name') if parent is None else None,
+            metric=m['metric'],
+            type=m['type'],
+            collisions=m['collisions'],
+            labelmap={ l: tuple(fields) for l, fields in labelmap.items() },
+            extra=extra,
+            regexp=tuple([ (f, re.compile(exp)) for f, exp in m['regexp'].items() ]),
+            static=tuple(m['static'].items()),
+            ignore=tuple(ignore),
+            join=(),
+            index=index,
+            fields=tuple([ field for field in labels if field not in skip_fields ]),
+            # identifies what the rule produces, regardless of where it's used
+            signature=(json.dumps(m, sort_keys=True, default=str), tuple([ (l, e.pattern if e else None) for l, e in ignore ])),
+            config=m,
+        )
+        if m['join']:
+            rule = rule._replace(join=tuple([ self.compile_rule(join, rule) for join in m['join'] ]))
+        return rule
+
+    def compile_config(self, config):
+        return [ self.compile_rule(m) for m in config['map'] ]
+
+    def compile_correlation(self, c):
+        normalize = c.get('normalize') or {}
+        whitespace = normalize.get('whitespace', 'strip')
+        case = normalize.get('case', 'upper')
+        if whitespace not in [ 'strip', 'remove', 'keep' ] or case not in [ 'upper', 'lower', 'keep' ]:
+            raise ValueError('correlate: normalize.whitespace must be strip, remove or keep, normalize.case upper, lower or keep')
+        correlation = Correlation(type=c.get('type', ''), primary=frozenset(c.get('primary') or []), secondary=frozenset(c.get('secondary') or []),
+                                  fields=tuple(c.get('fields') or [ 'brand', 'model' ]), whitespace=whitespace, case=case, prefixes=())
+        # the longest first, as normalized serials would be
+        prefixes = sorted([ self.normalize_serial(p, correlation) for p in normalize.get('prefixes') or [] ], key=len, reverse=True)
+        return correlation._replace(prefixes=tuple(prefixes))
+
+    @staticmethod
+    def normalize_serial(serial, c):
+        """ The serial as compared by correlation c: whitespace stripped or removed, case folded, vendor prefix removed """
+        if c.whitespace == 'strip':
+            serial = serial.strip()
+        elif c.whitespace == 'remove':
+            serial = ''.join(serial.split())
+        if c.case == 'upper':
+            serial = serial.upper()
+        elif c.case == 'lower':
+            serial = serial.lower()
+        for prefix in c.prefixes:
+            if serial.startswith(prefix) and len(serial) > len(prefix):
+                return serial[len(prefix):]
+        return serial
+
+    def correlate(self):
+        """
+        The correlation stage, once all rules are processed: for each entry of correlate: in the rules file, the rows of
+        its secondary rules having the same location and (normalized) serial as a row of its primary rules fill in the
+        fields that row is missing, add their sources to it, and are dropped. The other rows are left alone. Each
+        correlation is a single pass over the DB, with a hash index on (location, serial) of the primary rows.
+        """
+        for c in self.CORRELATIONS:
+            index = {}
+            secondary = []
+            for i, r in enumerate(self.DB):
+                if (c.type and r['type'] != c.type) or r['serial'] == '' or 'ignored' in r:
+                    continue
+                rule = (r['sources'] or [ None ])[0]
+                if rule in c.primary:
+                    # the first one, as push_row() would
+                    index.setdefault((r['location'], self.normalize_serial(r['serial'], c)), r)
+                elif rule in c.secondary:
+                    secondary += [ i ]
+            dropped = set()
+            for i in secondary:
+                r = self.DB[i]
+                target = index.get((r['location'], self.normalize_serial(r['serial'], c)))
+                if target is None:
+                    continue
+                for field in c.fields:
+                    if target.get(field, '') in [ '', [] ] and r.get(field, '') not in [ '', [] ]:
+                        self.debug(4, '     [correlate] %s from %s\ndr=%s\nr=%s', field, r['sources'][0], target, r)
+                        target[field] = r[field]
+                sources = target['sources']
+                target['sources'] = sources + [ source for source in r['sources'] if source not in sources ]
+                dropped.add(i)
+            self.debug(1, '[correlate] %s: %d rows merged into %d primary rows', ','.join(sorted(c.secondary)), len(dropped), len(index))
+            if len(dropped) > 0:
+                # reindexes, fields of the collision index may have been filled in
+                self.DB[:] = [ r for i, r in enumerate(self.DB) if i not in dropped ]
+
+    def get_duplicates(self, rows=None):
+        """
+        The rows (of the DB by default) sharing a location and serial, the serial being normalized as by default for
+        correlate:, as [ (location, serial, [ rows ]) ] in the order they first appear. Rows without serial, or ignored, are
+        left out.
+        """
+        c = self.compile_correlation({})
+        seen = {}
+        for r in self.DB if rows is None else rows:
+            if r['serial'] != '' and 'ignored' not in r:
+                seen.setdefault((r['location'], self.normalize_serial(r['serial'], c)), []).append(r)
+        return [ (location, serial, found) for (location, serial), found in seen.items() if len(found) > 1 ]
+
+    def print_duplicates(self, out=None):
+        for location, serial, rows in self.get_duplicates():
+            print('duplicate serial=' + serial + ', location=' + location + ', sources: ' +
+                  ' / '.join([ ','.join(r['sources']) for r in rows ]), file=out or sys.stderr)
+
+    @staticmethod
+    def promql_string(s):
+        return json.dumps(s, ensure_ascii=False)
+
+    @staticmethod
+    def promql_escape(s):
+        return re.sub(r'([\\.+*?()|\[\]{}^$])', r'\\\1', s)
+
+    @staticmethod
+    def promql_regexp(pattern):
+        """
+        Translates a python regexp used with re.match() into an equivalent PromQL (RE2, fully anchored) one, or returns
+        None when it can't be done safely: syntax that is python-only or means something else in RE2 (lookarounds,
+        backreferences, possessive quantifiers, ...) or classes that are broader in RE2 than in python (\\D, \\W, \\S).
+        A series missing the label is seen as the empty string by Prometheus, so patterns matching the empty string are
+        not translated either.
+        """
+        if re.search(r'[*+?}]\+|\[:|\{,', pattern):
+            return None
+        i = 0
+        while i < len(pattern):
+            if pattern[i] == '\\':
+                if i + 1 >= len(pattern) or (pattern[i + 1].isalnum() and pattern[i + 1] not in 'dswtnrf'):
+                    return None
+                i += 2
+                continue
+            if pattern[i] == '(' and pattern.startswith('?', i + 1) and not (pattern.startswith('?:', i + 1) or pattern.startswith('?P<', i + 1)):
+                return None
+            i += 1
+        try:
+            if re.match(pattern, ''):
+                return None
+        except re.error:
+            return None
+        return '(?:' + pattern + ')(?s:.*)'
+
+    def get_field_source(self, m, field):
+        """
+        Where the value of a field of the rows of rule m comes from: ('const', value), ('label', label) when it's a
+        plain copy of a metric label (stripped), or None when it can't be told beforehand (regexp, lookups, several labels)
+        """
+        for f, v in m.static:
+            if f == field:
+                return ('const', v)
+        for f, exp in m.regexp:
+            if field in exp.groupindex:
+                return None
+        labels = [ (l, strip) for l, fields in m.labelmap.items() for f, strip in fields if f == field ]
+        if len(labels) <= 0:
+            return ('const', self.get_field_default(m, field))
+        lookupfields = [ f for join in m.join for f in join.fields ]
+        if len(labels) == 1 and labels[0][1] and labels[0][0] not in lookupfields:
+            return ('label', labels[0][0])
+        return None
+
+    @staticmethod
+    def get_field_default(m, field):
+        """ The value of a field of the rows of rule m when none of its labels are there """
+        return m.type if field == 'type' else ''
+
+    # only these fields are never changed by push_row() merges, so they can be filtered before the rows are built
+    PUSHDOWN_FIELDS = [ 'type', 'model', 'location' ]
+
+    def get_pushdown_fields(self):
+        """ PUSHDOWN_FIELDS, but those that correlate() may fill in from other rows """
+        correlated = set([ field for c in self.CORRELATIONS for field in c.fields ])
+        return [ field for field in self.PUSHDOWN_FIELDS if field not in correlated ]
+
+    def is_filtered_out(self, m):
+        """ True if none of the rows of rule m can make it through --filter/--exclude """
+        fields = self.get_pushdown_fields()
+        for fk, fv in self.FILTER.items():
+            source = self.get_field_source(m, fk) if fk in fields else None
+            if source is not None and source[0] == 'const' and not InventoryDB.matches(source[1], fv):
+                return True
+        for fk, fv in self.EXCLUSION.items():
+            source = self.get_field_source(m, fk) if fk in fields else None
+            if source is not None and source[0] == 'const' and InventoryDB.matches(source[1], fv):
+                return True
+        return False
+
+    def get_matchers(self, entry, rule=None):
+        """
+        PromQL label matchers that select a subset of the series of entry without changing the outcome: the ignore rules
+        (when ignored rows are hidden anyway) and, for the main metric of rule, --filter/--exclude on labels
+        """
+        matchers = []
+        if self.options.hide_ignored:
+            for label, exp in entry.ignore:
+                if exp is None:
+                    matchers += [ label + '!=""' ]
+                elif self.promql_regexp(exp.pattern) is not None:
+                    matchers += [ label + '!~' + self.promql_string(self.promql_regexp(exp.pattern)) ]
+        if rule is not None:
+            fields = self.get_pushdown_fields()
+            for fk, fv in self.FILTER.items():
+                values = self.get_filter_regexp(fv)
+                source = self.get_field_source(rule, fk) if fk in fields and values is not None else None
+                # series without the label get the default value: they can only be left out if it doesn't match
+                if source is not None and source[0] == 'label' and not InventoryDB.matches(self.get_field_default(rule, fk), fv):
+                    # labels are stripped, a superset is good enough
+                    matchers += [ source[1] + '=~' + self.promql_string('(?s:.*)' + values + '(?s:.*)') ]
+            for fk, fv in self.EXCLUSION.items():
+                values = self.get_filter_regexp(fv)
+                source = self.get_field_source(rule, fk) if fk in fields and values is not None else None
+                if source is not None and source[0] == 'label':
+                    matchers += [ source[1] + '!~' + self.promql_string('\\s*' + values + '\\s*') ]
+        return matchers
+
+    def get_filter_regexp(self, predicate):
+        """ The values of a --filter/--exclude predicate as a PromQL regexp, or None if it is a regexp or has an empty value """
+        if hasattr(predicate, 'match'):
+            return None
+        values = [ predicate ] if isinstance(predicate, str) else sorted(set(predicate))
+        if '' in values or len(values) == 0:
+            return None
+        if len(values) == 1:
+            return self.promql_escape(values[0])
+        return '(?:' + '|'.join([ self.promql_escape(v) for v in values ]) + ')'
+
+    def get_required_labels(self, entry):
+        """
+        The metric labels that processing entry (a rule or a join) can read, or None if they can't be told
+        """
+        labels = set(entry.labelmap.keys())
+        if isinstance(entry.extra, str):
+            # a single 'extra' label is matched as a substring (l in extra), so any label name inside it counts
+            labels |= set([ entry.extra[i:j] for i in range(len(entry.extra)) for j in range(i + 1, len(entry.extra) + 1) ])
+        else:
+            labels |= entry.extra
+        labels |= set([ f for f, exp in entry.regexp ])
+        labels |= set([ label for label, exp in entry.ignore ])
+        for join in entry.join:
+            labels |= set(join.index)
+        labels = [ l for l in labels if re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', l) ]
+        if any([ not isinstance(l, str) for l in entry.labelmap.keys() ]):
+            return None
+        return labels
+
+    def plan_queries(self, rules):
+        """
+        Decides the PromQL query for each metric used by the rules: a metric shared by several rules or joins is still
+        fetched once, with only the matchers all of them agree on. With --project-labels, the query only returns the
+        labels that some rule or join reads, and how many series had them (see expand_counts()).
+        """
+        self.QUERIES = {}
+        self.PROJECTED = set()
+        self.REQUIRED = {}
+        self.SELECTORS = {}
+        self.PROJECTIONS = {}
+        pushdown = not self.get_option('no_pushdown', False)
+        # the sample values are needed with --lookback
+        projection = self.get_option('project_labels', False) and self.get_lookback() <= 0
+        usages = {}
+        for m in rules:
+            usages.setdefault(m.metric, []).append( (m, self.get_matchers(m, m) if pushdown else []) )
+            for join in m.join:
+                usages.setdefault(join.metric, []).append( (join, self.get_matchers(join) if pushdown else []) )
+        for metric, entries in usages.items():
+            matcherslist = [ matchers for entry, matchers in entries ]
+            common = [ matcher for matcher in matcherslist[0] if all([ matcher in matchers for matchers in matcherslist[1:] ]) ]
+            self.SELECTORS[metric] = sorted(set(common), key=common.index)
+            labels = [ self.get_required_labels(entry) for entry, matchers in entries ]
+            if None not in labels:
+                self.REQUIRED[metric] = frozenset(sum(labels, []))
+            if projection and None not in labels:
+                self.PROJECTIONS[metric] = sorted(set(sum(labels, [])))
+            query = self.build_query(metric, self.SELECTORS[metric])
+            if query != metric:
+                self.QUERIES[metric] = query
+            self.debug(2, '[plan_queries] naive: %s  optimized: %s', metric, query)
+
+    def build_query(self, metric, matchers):
+        """ The query for the series of metric with these label matchers, wrapped with count by (...) if projected """
+        query = metric
+        if '|' in metric:
+            # a batch of get_batch_results(), selected by its matchers only
+            query = '{' + ','.join(matchers) + '}'
+        elif len(matchers) > 0:
+            query = metric + '{' + ','.join(matchers) + '}'
+        if metric in self.PROJECTIONS:
+            query = 'count by (' + ','.join(self.PROJECTIONS[metric]) + ') (' + query + ')'
+            self.PROJECTED.add(query)
+        return query
+
+    @staticmethod
+    def expand_counts(rj):
+        """
+        Turns the result of a 'count by (...)' query back into one series per counted series, as the plain query would
+        have returned them (with the labels that were kept)
+        """
+        if rj.get('status') != 'success':
+            return rj
+        result = []
+        for row in rj['data']['result']:
+            result += [ {'metric': row['metric']} ] * int(float(row['value'][1]))
+        rj['data']['result'] = result
+        return rj
+
+    PROFILE_COLUMNS = [ ('Rule', 'rule'), ('Metric', 'metric'), ('HTTP s', 'http'), ('Bytes', 'bytes'), ('Decode s', 'decode'),
+                        ('Rows in', 'rows_in'), ('Ignored', 'rows_ignored'), ('Emitted', 'rows_emitted'),
+                        ('Merged', 'collisions_merged'), ('Process s', 'process'), ('push_row s', 'push_row') ]
+
+    def get_profile_stats(self, m):
+        """ The --profile counters of rule m, or of join m of the rule being processed """
+        key = (m.name, None) if m.name is not None else (self.current_rule, m.metric)
+        stats = self.PROFILE['rules'].get(key)
+        if stats is None:
+            stats = {'rule': key[0] if key[1] is None else str(key[0]) + ' > join', 'metric': m.metric,
+                     'rows_in': 0, 'rows_ignored': 0, 'rows_emitted': 0, 'collisions_merged': 0, 'process': 0.0, 'push_row': 0.0}
+            self.PROFILE['rules'][key] = stats
+        return stats
 
-    def get_filtered_results(self):
-        for r in self.DB:
-            finclude = True
-            if len(self.FILTER) != 0:
-                for fk, fv in self.FILTER.items():
-                    if r[fk] != fv:
-                        finclude = False
-            elif len(self.EXCLUSION) != 0:
-                for fk, fv in self.EXCLUSION.items():
-                    if r[fk] == fv:
-                        finclude = False
-            if finclude:
-                yield r
-
-
-    def print_results(self):
+    def profile_query(self, metric, http, size, decode):
+        # called from the prefetch threads too
+        with self.cache_lock:
+            stats = self.PROFILE['queries'].setdefault(metric, {'queries': 0, 'http': 0.0, 'bytes': 0, 'decode': 0.0})
+            stats['queries'] += 1
+            stats['http'] += http
+            stats['bytes'] += size
+            stats['decode'] += decode
+
+    def profile_phase(self, phase, start):
+        if self.PROFILE is None:
+            return start
+        self.PROFILE['phases'][phase] = self.PROFILE['phases'].get(phase, 0.0) + time.perf_counter() - start
+        return time.perf_counter()
+
+    def get_profile(self):
+        """
+        The --profile report: time per phase of run(), and per rule and join, the queries of its metric (HTTP time,
+        bytes, decode time, shared by all rules using the metric) and the processing of its rows
+        """
+        rules = []
+        for stats in self.PROFILE['rules'].values():
+            stats = dict(stats)
+            stats.update(self.PROFILE['queries'].get(stats['metric'], {'queries': 0, 'http': 0.0, 'bytes': 0, 'decode': 0.0}))
+            rules += [ stats ]
+        return {'phases': dict(self.PROFILE['phases']), 'rules': rules}
+
+    def print_profile(self, out=None):
+        from prettytable import PrettyTable
+        profile = self.get_profile()
+        tbl = PrettyTable([ title for title, field in self.PROFILE_COLUMNS ])
+        for stats in profile['rules']:
+            tbl.add_row([ '%.3f' % stats[field] if isinstance(stats[field], float) else stats[field] for title, field in self.PROFILE_COLUMNS ])
+        phases = PrettyTable([ 'Phase', 'Seconds' ])
+        for phase, elapsed in profile['phases'].items():
+            phases.add_row([ phase, '%.3f' % elapsed ])
+        # on stderr, not to get mixed with the --output
+        print(tbl, file=out or sys.stderr)
+        print(phases, file=out or sys.stderr)
+        if self.get_option('profile_json', ''):
+            with open(self.options.profile_json, 'w') as f:
+                json.dump(profile, f, indent=2)
+
+    @staticmethod
+    def parse_filter(text):
+        """
+        Parses field=value[,field=value...] as given to --filter and --exclude: field=v1|v2 is any of the values, and
+        field~regexp matches the field with the regexp (re.match())
+        """
+        filter = {}
+        for f in text.split(','):
+            found = re.match(r'^([^=~]+)([=~])(.*)$', f, re.S)
+            if not found:
+                raise ValueError('expected field=value or field~regexp: ' + f)
+            k, op, v = found.groups()
+            if op == '~':
+                try:
+                    filter[k] = re.compile(v)
+                except re.error as e:
+                    raise ValueError('bad regexp for ' + k + ': ' + str(e))
+            elif '|' in v:
+                filter[k] = tuple(v.split('|'))
+            else:
+                filter[k] = v
+        return filter
+
+    def get_filtered_results(self, filter=None, exclusion=None):
+        """
+        Rows of the DB that pass --filter/--exclude, or the filter/exclusion given (as parsed by parse_filter(), or any
+        predicates of InventoryDB.select())
+        """
+        if filter is None and exclusion is None:
+            filter, exclusion = self.FILTER, self.EXCLUSION
+        for r in self.DB.select(filter, exclusion):
+            yield r
+
+
+    def get_columns(self):
+        columns = [ ('Type', 'type'), ('Brand', 'brand'), ('Model', 'model'), ('Serial', 'serial'), ('Location/Owner', 'location'), ('Extra', 'extra') ]
         if self.options.show_sources:
-            tbl = PrettyTable(["Type", "Brand", "Model", "Serial", "Location/Owner", "Extra", "Sources"])
+            columns += [ ('Sources', 'sources') ]
+        if self.get_lookback() > 0:
+            columns += [ ('Last seen', 'last_seen') ]
+        return columns
+
+    @staticmethod
+    def format_cell(r, field):
+        v = r.get(field, '')
+        if field == 'extra':
+            return ';'.join(v)
+        if field == 'sources':
+            return ','.join(v)
+        if isinstance(v, dict):
+            return ';'.join([ k + ': ' + str(old) for k, old in v.items() ])
+        if field == 'last_seen':
+            return datetime.datetime.fromtimestamp(v, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ') if v else ''
+        return v
+
+    def print_results(self, out=None, rows=None, columns=None):
+        """
+        Prints the filtered DB (or, after a run with --diff-against, the differences) in the format chosen with --output. Except for
+        'table', rows are written as they come out of get_filtered_results(), in chunks of OUTPUT_CHUNK rows
+        """
+        if out is None:
+            out = sys.stdout
+        if rows is None and self.CHANGES is not None:
+            rows = self.CHANGES
+            columns = [ ('Change', 'change') ] + self.get_columns() + [ ('Previous', 'previous') ]
+        if rows is None:
+            rows = self.get_filtered_results()
+        if columns is None:
+            columns = self.get_columns()
+        output = self.get_option('output', 'table')
+        if output == 'table':
+            return self.print_table(out, rows, columns)
+        if output == 'csv':
+            lines = self.format_csv(rows, columns)
+        elif output == 'jsonl':
+            lines = self.format_jsonl(rows, columns)
+        elif output == 'json':
+            lines = self.format_json(rows, columns)
         else:
-            tbl = PrettyTable(["Type", "Brand", "Model", "Serial", "Location/Owner", "Extra"])
-        for r in self.get_filtered_results():
-            if self.options.show_sources:
-                tbl.add_row([ r['type'], r['brand'], r['model'], r['serial'], r['location'], ';'.join(r['extra']), ','.join(r['sources']) ])
+            return self.error('Unknown output format: ' + str(output))
+        chunk = []
+        for line in lines:
+            chunk += [ line ]
+            if len(chunk) >= self.OUTPUT_CHUNK:
+                out.write(''.join(chunk))
+                chunk = []
+        out.write(''.join(chunk))
+        out.flush()
+
+    def print_table(self, out, rows, columns):
+        from prettytable import PrettyTable
+        tbl = PrettyTable([ title for title, field in columns ])
+        for r in rows:
+            tbl.add_row([ self.format_cell(r, field) for title, field in columns ])
+
+        print(tbl, file=out)
+
+    def format_csv(self, rows, columns):
+        # same columns and joined lists as the table
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow([ title for title, field in columns ])
+        for r in rows:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            writer.writerow([ self.format_cell(r, field) for title, field in columns ])
+        yield buf.getvalue()
+
+    @staticmethod
+    def get_record(r, columns):
+        return dict([ (field, list(r[field]) if field in ['extra', 'sources'] else r.get(field)) for title, field in columns ])
+
+    def format_jsonl(self, rows, columns):
+        for r in rows:
+            yield json.dumps(self.get_record(r, columns), ensure_ascii=False) + '\n'
+
+    def format_json(self, rows, columns):
+        # a single JSON array, still written row by row
+        sep = '[\n'
+        for r in rows:
+            yield sep + json.dumps(self.get_record(r, columns), ensure_ascii=False)
+            sep = ',\n'
+        yield '[]\n' if sep == '[\n' else '\n]\n'
+
+    def get_snapshot(self):
+        """
+        Returns { rule name: [ hash, rows ] } for the filtered DB, rows being lists of SNAPSHOT_FIELDS and the hash
+        a content hash of their compared fields (the sum of the hashes of each row, so that their order does not matter)
+        """
+        blake2b = hashlib.blake2b
+        rules = {}
+        with paused_gc():
+            for r in self.get_filtered_results():
+                sources = r['sources']
+                row = [ r['type'], r['serial'], r['location'], r['brand'], r['model'], r['extra'], sources ]
+                name = sources[0] if len(sources) > 0 else ''
+                entry = rules.get(name)
+                if entry is None:
+                    entry = rules[name] = [ 0, [] ]
+                entry[0] += int.from_bytes(blake2b(repr(row[:SNAPSHOT_COMPARED]).encode('UTF-8'), digest_size=16).digest(), 'big')
+                entry[1].append(row)
+            for entry in rules.values():
+                entry[0] &= SNAPSHOT_HASH_MASK
+        return rules
+
+    def save_snapshot(self, path, snapshot=None):
+        """
+        Writes a snapshot file: a header line with the fields and the rules with their hashes and row counts, then one
+        line per rule (in the same order) with its rows
+        """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        names = sorted(snapshot)
+        header = {'version': SNAPSHOT_VERSION, 'created': time.time(), 'fields': SNAPSHOT_FIELDS,
+                  'rules': [ [ name, '%032x' % snapshot[name][0], len(snapshot[name][1]) ] for name in names ]}
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='UTF-8') as f:
+            f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            for name in names:
+                f.write(json.dumps(snapshot[name][1], ensure_ascii=False) + '\n')
+        os.replace(tmp, path)
+        self.debug(1, 'Snapshot of %d rows saved to %s', sum([ h[2] for h in header['rules'] ]), path)
+
+    def load_snapshot(self, path, skip=None):
+        """
+        Reads a snapshot file into { rule name: [ hash, rows ] }. Rows of the rules whose hash is the one given in
+        skip ({ rule name: hash }) are not decoded (rows is None)
+        """
+        with open(path, encoding='UTF-8') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != SNAPSHOT_VERSION:
+                raise ValueError('unsupported snapshot version: ' + str(header.get('version')))
+            snapshot = {}
+            for name, h, count in header['rules']:
+                line = f.readline()
+                h = int(h, 16)
+                if skip is not None and skip.get(name) == h:
+                    snapshot[name] = [ h, None ]
+                else:
+                    snapshot[name] = [ h, json.loads(line) ]
+        return snapshot
+
+    def diff_snapshot(self, path, current=None):
+        """
+        Returns the rows added, removed or changed since the snapshot in path, keyed on (type, location, serial).
+        Rules with the same content hash on both sides are skipped
+        """
+        if current is None:
+            current = self.get_snapshot()
+        changes = []
+        with paused_gc():
+            try:
+                previous = self.load_snapshot(path, dict([ (name, entry[0]) for name, entry in current.items() ]))
+            except (OSError, ValueError) as e:
+                self.error('Cannot read snapshot ' + path + ': ' + str(e))
+                return changes
+            for name in sorted(set(current) | set(previous)):
+                new = current.get(name, [ None, [] ])
+                old = previous.get(name, [ None, [] ])
+                if new[0] == old[0]:
+                    self.debug(2, '[diff_snapshot] %s: unchanged (%d rows)', name, len(new[1]))
+                    continue
+                changes += self.diff_rows(old[1], new[1])
+        return changes
+
+    def diff_rows(self, old, new):
+        # rows equal on both sides cancel out first, then what remains is paired by key (several rows can share one)
+        pending = {}
+        for row in old:
+            pending.setdefault(tuple(row[:SNAPSHOT_KEY]), []).append(row)
+        unmatched = []
+        for row in new:
+            candidates = pending.get(tuple(row[:SNAPSHOT_KEY]))
+            compared = row[:SNAPSHOT_COMPARED]
+            for i, candidate in enumerate(candidates or ()):
+                if candidate[:SNAPSHOT_COMPARED] == compared:
+                    del candidates[i]
+                    break
+            else:
+                unmatched += [ row ]
+        for row in unmatched:
+            candidates = pending.get(tuple(row[:SNAPSHOT_KEY]))
+            if candidates:
+                was = candidates.pop(0)
+                changed = dict([ (field, was[i]) for i, field in enumerate(SNAPSHOT_FIELDS[:SNAPSHOT_COMPARED]) if was[i] != row[i] ])
+                yield self.get_change('changed', row, changed)
             else:
-                tbl.add_row([ r['type'], r['brand'], r['model'], r['serial'], r['location'], ';'.join(r['extra']) ])
+                yield self.get_change('added', row)
+        for candidates in pending.values():
+            for row in candidates:
+                yield self.get_change('removed', row)
 
-        print(tbl)
+    @staticmethod
+    def get_change(change, row, previous=None):
+        r = dict(zip(SNAPSHOT_FIELDS, row))
+        r['change'] = change
+        r['previous'] = previous or {}
+        return r
 
 
     def run(self):
-        self.debug(1, 'Debug level: ' + str(self.getDebug()))
-        self.debug(1, 'Config: ' + self.options.config)
-        self.debug(1, 'Endpoint: ' + self.options.prom_endpoint)
+        """
+        Collects the inventory into the DB: arun() on an event loop of its own. Returns the errors per rule (ERRORS).
+        From a coroutine (or a thread running an event loop), await arun() instead.
+        """
+        import asyncio
+        return asyncio.run(self.arun())
+
+    async def arun(self, deadline=None):
+        """
+        Collects the inventory into the DB without blocking the event loop: aiter_rules(), then finish(). Returns the
+        errors per rule (ERRORS, empty if all went fine): with errors, the DB holds the rows of the rules that made it.
+        When cancelled, no more queries are started and the DB is left with the rules processed so far.
+        """
+        import asyncio
+        async for result in self.aiter_rules(deadline):
+            pass
+        await asyncio.get_running_loop().run_in_executor(None, self.finish)
+        return self.ERRORS
+
+    async def aiter_rules(self, deadline=None):
+        """
+        Collects the inventory as arun() does, yielding a RuleResult for each selected rule on each endpoint (in the
+        order of the rules file) as soon as it is processed. Queries run in a pool of --concurrency threads sharing the
+        HTTP session and its connection pool, as prefetch() does, and a rule is processed (in a thread of its own, one
+        rule at a time, so collisions are merged as in a serial run) once its results and those of its joins are in.
+        After deadline seconds (--deadline by default, 0 for none) no more queries are started, those running are cut
+        short (their timeouts and retries are capped to the time left) and the rules left are yielded without rows,
+        with the error 'deadline exceeded'. Errors are also kept in ERRORS, by rule name.
+        With --profile, rules are only processed once all queries are done, so that the phases can be told apart.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if deadline is None:
+            deadline = float(self.get_option('deadline', 0) or 0)
+        expires = time.monotonic() + deadline if deadline > 0 else None
+        cancelled = threading.Event()
+        self.ERRORS = {}
+        concurrency = max(1, int(self.get_option('concurrency', 4)))
+        # the threads of this run only: queries are cut short at the deadline, and stop being sent when cancelled
+        fetcher = ThreadPoolExecutor(max_workers=concurrency, initializer=self.set_run_state, initargs=(cancelled, expires))
+        processor = ThreadPoolExecutor(max_workers=1, initializer=self.set_run_state, initargs=(cancelled, expires))
+        fetches = {}
+        processing = None
+        finished = False
+
+        async def wait(futures):
+            """ Waits for the futures until the deadline, returns whether they are all done """
+            futures = set([ f for f in futures if not f.done() ])
+            if len(futures) > 0:
+                await asyncio.wait(futures, timeout=None if expires is None else max(0.0, expires - time.monotonic()))
+            return all([ f.done() for f in futures ])
+
+        try:
+            rules, endpoints, start = await loop.run_in_executor(processor, self.prepare)
+            entries = self.get_prefetch_entries(rules)
+            for ep in endpoints:
+                for batch in await loop.run_in_executor(fetcher, self.get_batches, entries, ep):
+                    future = loop.run_in_executor(fetcher, self.prefetch_batch, batch, ep)
+                    for entry in batch:
+                        fetches[(ep['url'], entry['metric'])] = future
+            self.debug(1, '[prefetch] running %d queries with concurrency=%d', len(set(fetches.values())), concurrency)
+
+            expired = False
+            if self.PROFILE is not None:
+                expired = not await wait(fetches.values())
+                start = self.profile_phase('prefetch', start)
+            workers = int(self.get_option('workers', 1))
+            if workers > 1:
+                # the workers are started once all the results are in
+                expired = expired or not await wait(fetches.values())
+            if workers > 1 and not expired:
+                fetcher.shutdown(wait=True)
+                processing = loop.run_in_executor(processor, self.process_parallel, rules, endpoints, workers)
+                for result in await processing:
+                    yield result
+            else:
+                for ep, m in [ (ep, m) for ep in endpoints for m in rules ]:
+                    futures = [ fetches[(ep['url'], entry['metric'])] for entry in (m, ) + m.join ]
+                    expired = expired or not await wait(futures)
+                    if expired:
+                        cancelled.set()
+                        yield self.skip_rule(m, ep, 'deadline exceeded')
+                        continue
+                    for future in futures:
+                        future.result()
+                    processing = loop.run_in_executor(processor, self.process_rule, m, ep)
+                    yield await processing
+            self.profile_phase('process', start)
+            finished = True
+        finally:
+            if not finished:
+                cancelled.set()
+            for future in fetches.values():
+                future.cancel()
+            fetcher.shutdown(wait=False, cancel_futures=True)
+            if processing is not None and not processing.done():
+                # the DB is only consistent again once the rule being processed is pushed
+                await asyncio.wait([ processing ])
+            processor.shutdown(wait=False)
+
+    def prepare(self):
+        """ The start of a run: loads the config and plans the queries, returns the rules selected, the endpoints and the time """
+        if self.get_option('profile', False) or self.get_option('profile_json', ''):
+            self.PROFILE = {'phases': {}, 'rules': {}, 'queries': {}}
+        start = time.perf_counter()
+        # queries that failed in a previous run are tried again
+        self.FAILED_QUERIES = {}
+        self.debug(1, 'Debug level: %s', self.getDebug())
+        self.debug(1, 'Config: %s', self.options.config)
+        endpoints = self.get_endpoints()
+        self.federated = len(endpoints) > 1
+        self.debug(1, 'Endpoint: %s', ', '.join([ ep['url'] for ep in endpoints ]))
         self.load_config()
+        start = self.profile_phase('load_config', start)
         #self.debug_var(3, self.MAP)
-        for metric in self.MAP['map']:
-            process_metric = False
-            if len(self.options.only) <= 0:
-                if (len(self.options.exception) <= 0):
-                    process_metric = True
-                else:
-                    if metric['name'] != self.options.exception:
-                        process_metric = True
+        rules = []
+        for metric in self.RULES:
+            if self.is_selected(metric):
+                rules += [ metric ]
             else:
-                if metric['name'] == self.options.only:
-                    process_metric = True
+                self.debug(1, 'Skipping name "%s" for not being included with --only: %s', metric.name, self.options.only)
+        if not self.get_option('no_pushdown', False):
+            for metric in [ m for m in rules if self.is_filtered_out(m) ]:
+                self.debug(1, 'Skipping name "%s" as none of its rows can match --filter/--exclude', metric.name)
+                rules.remove(metric)
 
-            if process_metric:
-                self.complete_with_defaults(metric)
-                self.process(metric, self.DB)
-            else:
-                self.debug(1, 'Skipping name "' + str(metric['name']) + '" for not being included with --only: ' + str(self.options.only))
-                continue
+        self.plan_queries(rules)
+        start = self.profile_phase('plan_queries', start)
+        return rules, endpoints, start
+
+    def process_rule(self, m, endpoint=None):
+        """ process() of rule m into the DB, as a RuleResult: its error is the last query of the rule (or its joins) that failed """
+        endpoint = self.get_endpoint(endpoint)
+        previous, self.last_error = self.last_error, None
+        before = len(self.DB)
+        self.process(m, self.DB, endpoint)
+        error, self.last_error = self.last_error, self.last_error or previous
+        if error is not None:
+            self.set_rule_error(m, endpoint, error)
+        return RuleResult(m.name, endpoint['url'], self.DB[before:], error)
+
+    def skip_rule(self, m, endpoint, error):
+        """ A rule not processed (counted as a failure of its metric), as a RuleResult without rows """
+        endpoint = self.get_endpoint(endpoint)
+        self.error('Rule [' + str(m.name) + '] not processed: ' + error)
+        self.FAILURES[m.metric] = self.FAILURES.get(m.metric, 0) + 1
+        self.set_rule_error(m, endpoint, error)
+        return RuleResult(m.name, endpoint['url'], [], error)
+
+    def set_rule_error(self, m, endpoint, error):
+        # errors of a federated run say on which endpoint
+        self.ERRORS[m.name] = endpoint['url'] + ': ' + error if self.federated else error
 
+    def finish(self):
+        """ The end of a run, once all rules are processed: correlation, --duplicates, --snapshot/--diff-against and --profile """
+        start = time.perf_counter()
+        if len(self.CORRELATIONS) > 0:
+            self.correlate()
+            start = self.profile_phase('correlate', start)
+        if self.get_option('duplicates', False):
+            self.print_duplicates()
+
+        if self.get_option('diff_against', '') or self.get_option('snapshot', ''):
+            snapshot = self.get_snapshot()
+            # compared before saving, so that the same file can be given to both
+            if self.get_option('diff_against', ''):
+                self.CHANGES = self.diff_snapshot(self.options.diff_against, snapshot)
+            if self.get_option('snapshot', ''):
+                self.save_snapshot(self.options.snapshot, snapshot)
+            start = self.profile_phase('snapshot', start)
+
+        if self.disk_cache_written:
+            self.evict_disk_cache()
+
+        if self.PROFILE is not None:
+            self.print_profile()
         return
 
+    def is_selected(self, metric):
+        if len(self.options.only) <= 0:
+            if (len(self.options.exception) <= 0):
+                return True
+            return metric.name != self.options.exception
+        return metric.name == self.options.only
+
     @staticmethod
-    def parse_options():
+    def parse_options(args=None):
         PARSER = argparse.ArgumentParser(
             description=DESCRIPTION, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         PARSER.add_argument(
@@ -395,19 +2388,85 @@ class PrometheusInventory:
         PARSER.add_argument(
             '-v', default=0, dest='debug', action='count', help='Verbosity (repeat to increase level)')
         PARSER.add_argument(
-            '-u', dest='prom_endpoint', help='Prometheus URL (user:pass from env PROMCRED)')
+            '-u', dest='prom_endpoint', action='append', help='Prometheus URL (user:pass from env PROMCRED), repeat or use comma for several')
+        PARSER.add_argument(
+            '--endpoints-file', default='', dest='endpoints_file', help='File listing Prometheus URLs to collect from, one "<url> [<user>:<pass>]" per line')
         PARSER.add_argument(
             '--show-sources', default=False, action='store_true', dest='show_sources', help='Shows which metrics contributed for each record')
+        PARSER.add_argument(
+            '--output', default='table', choices=['table', 'csv', 'jsonl', 'json'], dest='output', help='Output format. Except for table, rows are written as they are produced')
+        PARSER.add_argument(
+            '--snapshot', default='', dest='snapshot', help='Save the (filtered) inventory to this file, to be compared with --diff-against later')
+        PARSER.add_argument(
+            '--diff-against', default='', dest='diff_against', help='Only print what was added, removed or changed since this --snapshot file')
+        PARSER.add_argument(
+            '--serve', default='', dest='serve', help='Run as a daemon serving the inventory (and its own metrics) over HTTP on [<host>]:<port>')
+        PARSER.add_argument(
+            '--refresh-interval', default=3600, type=float, dest='refresh_interval', help='With --serve, seconds between inventory refreshes')
+        PARSER.add_argument(
+            '--profile', default=False, action='store_true', dest='profile', help='Print (on stderr) the time, bytes and rows spent on each rule and join, and on each phase')
+        PARSER.add_argument(
+            '--profile-json', default='', dest='profile_json', help='Also write the --profile report to this JSON file')
+        PARSER.add_argument(
+            '--duplicates', default=False, action='store_true', dest='duplicates', help='Report (on stderr) the rows sharing the same serial and location')
         PARSER.add_argument(
             '--hide-ignored', default=False, action='store_true', dest='hide_ignored', help='Omits records marked as "ignored" (removed from final resultset)')
         PARSER.add_argument(
-            '--filter', default='', dest='filter', help='Filters out resultset for anything that doesn\'t match the field=value combinations, use comma for several')
+            '--filter', default='', dest='filter', help='Filters out resultset for anything that doesn\'t match the field=value combinations (field=v1|v2 for any of several values, field~regexp for a regexp), use comma for several')
         PARSER.add_argument(
-            '--exclude', default='', dest='exclude', help='Filters out resultset for anything that matches the field=value combinations (opposite of --filter), use comma for several')
+            '--exclude', default='', dest='exclude', help='Filters out resultset for anything that matches any of the field=value combinations (opposite of --filter, can be combined with it), use comma for several')
         PARSER.add_argument(
             '--only', default='', dest='only', help='Execute only config with specified name')
         PARSER.add_argument(
             '--except', default='', dest='exception', help='Execute all config but specified name (opposite of --only)')
+        PARSER.add_argument(
+            '--concurrency', default=4, type=int, dest='concurrency', help='How many Prometheus queries to run at the same time')
+        PARSER.add_argument(
+            '--shard-label', default='instance', dest='shard_label', help='Label by which queries are split into shards, when too large for Prometheus (or a proxy) or with --shards')
+        PARSER.add_argument(
+            '--max-shards', default=256, type=int, dest='max_shards', help='Give up splitting a query that is still too large in this many shards')
+        PARSER.add_argument(
+            '--shards', default=1, type=int, dest='shards', help='Split each query into at least this many shards (by --shard-label), fetched concurrently. Series come back in another order, which can change how collisions are merged')
+        PARSER.add_argument(
+            '--batch-queries', default=False, action='store_true', dest='batch_queries', help='Query metrics with the same label matchers at once ({__name__=~"a|b|..."}), one query per batch')
+        PARSER.add_argument(
+            '--batch-max-series', default=10000, type=int, dest='batch_max_series', help='With --batch-queries, at most this many series per batch (counted with one extra query)')
+        PARSER.add_argument(
+            '--workers', default=1, type=int, dest='workers', help='Turn the results into rows in this many processes, the DB is the same as with 1')
+        PARSER.add_argument(
+            '--deadline', default=0, type=float, dest='deadline', help='Seconds the whole collection may take: rules not processed by then are reported as failed (0 for no deadline)')
+        PARSER.add_argument(
+            '--connect-timeout', default=5, type=float, dest='connect_timeout', help='Seconds to wait for a connection to Prometheus')
+        PARSER.add_argument(
+            '--read-timeout', default=60, type=float, dest='read_timeout', help='Seconds to wait for Prometheus to answer a query')
+        PARSER.add_argument(
+            '--retries', default=3, type=int, dest='retries', help='How many times to retry a query on connection errors or 5xx responses')
+        PARSER.add_argument(
+            '--retry-backoff', default=0.5, type=float, dest='retry_backoff', help='Exponential backoff factor (seconds) between retries')
+        PARSER.add_argument(
+            '--no-gzip', default=False, action='store_true', dest='no_gzip', help='Do not ask Prometheus for gzip compressed responses')
+        PARSER.add_argument(
+            '--no-pushdown', default=False, action='store_true', dest='no_pushdown', help='Do not turn ignore_regexp, --filter and --exclude into PromQL label matchers')
+        PARSER.add_argument(
+            '--stream', default=False, action='store_true', dest='stream', help='Parse responses while they are received, keeping only the labels used by the rules')
+        PARSER.add_argument(
+            '--cache-dir', default='', dest='cache_dir', help='Keep query results (and the compiled rules file) in this folder, to be reused by later runs')
+        PARSER.add_argument(
+            '--cache-ttl', default=86400, type=float, dest='cache_ttl', help='Seconds during which results in --cache-dir are reused')
+        PARSER.add_argument(
+            '--cache-max-size', default=1024, type=float, dest='cache_max_size', help='MB that --cache-dir can grow to, before the oldest results are removed (at the end of a run)')
+        PARSER.add_argument(
+            '--refresh', default=False, action='store_true', dest='refresh', help='Query Prometheus even if --cache-dir has recent results (and update them), unless --offline')
+        PARSER.add_argument(
+            '--offline', default=False, action='store_true', dest='offline', help='Only use results from --cache-dir, regardless of their age')
+        PARSER.add_argument(
+            '--lookback', default='', dest='lookback', help='Also collect series that were only seen within this duration (e.g. 6h, 7d), and record when each row was last seen')
+        PARSER.add_argument(
+            '--lookback-window', default='', dest='lookback_window', help='With --lookback, query at most this duration at a time (one query per window, per metric)')
+        PARSER.add_argument(
+            '--lookback-step', default='5m', dest='lookback_step', help='With --lookback, resolution at which samples are looked for (subquery step)')
+        PARSER.add_argument(
+            '--project-labels', default=False, action='store_true', dest='project_labels', help='Only fetch the labels used by the rules (wraps queries with count by (...)). Series come back in another order, which can change how collisions are merged')
         PARSER.add_argument('--version', action='version', version='%(prog)s {}'.format(VERSION))
-        return PARSER.parse_args()
+        return PARSER.parse_args(args)
 
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Serve the inventory collected from Prometheus over HTTP, refreshing it in the background.
+#
+# (c) 2020, Nuno Tavares <n.tavares@portavita.eu>
+#
+import hashlib
+import threading
+import time
+import urllib.parse
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PrometheusInventory import PrometheusInventory
+
+
+class InventoryState(namedtuple('InventoryState', ['runner', 'generated', 'duration', 'rows'])):
+    """
+    The result of a complete refresh: the PrometheusInventory holding the DB (its query results and lookups dropped),
+    when it finished, how long it took and the number of rows per rule. Replaced as a whole by the next complete
+    refresh, never modified.
+    """
+
+
+class InventoryDaemon(object):
+    """
+    Refreshes the inventory every --refresh-interval seconds and serves the last complete one on --serve:
+
+      /inventory   the rows, as ?format=json (default), jsonl or csv; ?filter= and ?exclude= as --filter/--exclude
+      /metrics     refresh duration and outcome, rows per rule, query failures per metric
+
+    A refresh with failed queries only replaces the inventory when there is none yet.
+    """
+    FORMATS = {
+        'json': 'application/json; charset=utf-8',
+        'jsonl': 'application/x-ndjson; charset=utf-8',
+        'csv': 'text/csv; charset=utf-8',
+    }
+    RENDERED_MAX = 64
+
+    def __init__(self, options):
+        self.options = options
+        self.logger = PrometheusInventory(options)
+        self.state = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.refreshes = {'success': 0, 'failure': 0}
+        self.failures = {}
+        self.last_duration = 0.0
+        self.rendered = {}
+        self.server = None
+
+    def refresh(self):
+        runner = PrometheusInventory(self.options)
+        start = time.time()
+        try:
+            runner.run()
+        except Exception as e:
+            runner.error('Refresh failed: ' + str(e))
+            runner.FAILURES[''] = runner.FAILURES.get('', 0) + 1
+        duration = time.time() - start
+        # only the DB is served: don't keep the query results and lookups alive next to those of the next refresh
+        runner.CACHE, runner.LOOKUPS, runner.FAILED_QUERIES = {}, {}, {}
+        if runner.session is not None:
+            runner.session.close()
+            runner.session = None
+        rows = {}
+        for r in runner.DB:
+            sources = r['sources']
+            rule = sources[0] if len(sources) > 0 else ''
+            rows[rule] = rows.get(rule, 0) + 1
+        with self.lock:
+            self.last_duration = duration
+            for metric, count in runner.FAILURES.items():
+                self.failures[metric] = self.failures.get(metric, 0) + count
+            if len(runner.FAILURES) > 0:
+                self.refreshes['failure'] += 1
+                if self.state is not None:
+                    self.logger.error('Refresh had failed queries, still serving the inventory of ' + runner.getTimestamp())
+                    return False
+            else:
+                self.refreshes['success'] += 1
+            self.state = InventoryState(runner, time.time(), duration, rows)
+            self.rendered = {}
+        self.logger.debug(1, '[refresh] %d rows in %.3fs', len(runner.DB), duration)
+        return True
+
+    def refresh_loop(self):
+        while not self.stopping.is_set():
+            self.refresh()
+            self.stopping.wait(float(self.options.refresh_interval))
+
+    def render(self, fmt, filter, exclude):
+        """
+        The body and ETag of /inventory for the current state, rendered once per state and set of parameters
+        """
+        with self.lock:
+            state = self.state
+            key = (fmt, filter, exclude)
+            if key in self.rendered:
+                return self.rendered[key]
+        runner = state.runner
+        rows = runner.get_filtered_results(runner.parse_filter(filter) if filter else None,
+                                           runner.parse_filter(exclude) if exclude else None)
+        columns = runner.get_columns()
+        if fmt == 'csv':
+            lines = runner.format_csv(rows, columns)
+        elif fmt == 'jsonl':
+            lines = runner.format_jsonl(rows, columns)
+        else:
+            lines = runner.format_json(rows, columns)
+        body = ''.join(lines).encode('UTF-8')
+        rendered = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+        with self.lock:
+            if self.state is state:
+                if len(self.rendered) >= self.RENDERED_MAX:
+                    self.rendered = {}
+                self.rendered[key] = rendered
+        return rendered
+
+    def get_metrics(self):
+        with self.lock:
+            state = self.state
+            lines = [
+                '# HELP prometheus_inventory_refresh_duration_seconds Duration of the last inventory refresh.',
+                '# TYPE prometheus_inventory_refresh_duration_seconds gauge',
+                'prometheus_inventory_refresh_duration_seconds %f' % self.last_duration,
+                '# HELP prometheus_inventory_refreshes_total Inventory refreshes, by outcome.',
+                '# TYPE prometheus_inventory_refreshes_total counter',
+            ]
+            for result in sorted(self.refreshes):
+                lines += [ 'prometheus_inventory_refreshes_total{result="%s"} %d' % (result, self.refreshes[result]) ]
+            lines += [
+                '# HELP prometheus_inventory_query_failures_total Failed Prometheus queries, by metric.',
+                '# TYPE prometheus_inventory_query_failures_total counter',
+            ]
+            for metric in sorted(self.failures):
+                lines += [ 'prometheus_inventory_query_failures_total{metric="%s"} %d' % (self.escape(metric), self.failures[metric]) ]
+        if state is not None:
+            lines += [
+                '# HELP prometheus_inventory_last_refresh_timestamp_seconds When the inventory being served was collected.',
+                '# TYPE prometheus_inventory_last_refresh_timestamp_seconds gauge',
+                'prometheus_inventory_last_refresh_timestamp_seconds %f' % state.generated,
+                '# HELP prometheus_inventory_rows Rows of the inventory being served, by rule.',
+                '# TYPE prometheus_inventory_rows gauge',
+            ]
+            for rule in sorted(state.rows):
+                lines += [ 'prometheus_inventory_rows{rule="%s"} %d' % (self.escape(rule), state.rows[rule]) ]
+        return ('\n'.join(lines) + '\n').encode('UTF-8')
+
+    @staticmethod
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def get_address(self):
+        host, sep, port = self.options.serve.rpartition(':')
+        return (host, int(port))
+
+    def start(self, refresh=True):
+        """ Starts the refresh loop (unless refresh is False) and the HTTP server in background threads, returns the server """
+        daemon = self
+
+        class Handler(InventoryRequestHandler):
+            pass
+        Handler.daemon = daemon
+        self.server = ThreadingHTTPServer(self.get_address(), Handler)
+        self.server.daemon_threads = True
+        if refresh:
+            threading.Thread(target=self.refresh_loop, name='refresh', daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, name='http', daemon=True).start()
+        self.logger.info('Serving the inventory on http://%s:%d/inventory' % self.server.server_address[:2])
+        return self.server
+
+    def stop(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def serve(self):
+        self.start()
+        try:
+            while not self.stopping.wait(3600):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+
+class InventoryRequestHandler(BaseHTTPRequestHandler):
+    daemon = None
+
+    def log_message(self, format, *args):
+        self.daemon.logger.debug(2, '[http] %s ' + format, self.address_string(), *args)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/metrics':
+            return self.send_body(200, 'text/plain; version=0.0.4; charset=utf-8', self.daemon.get_metrics())
+        if url.path != '/inventory':
+            return self.send_body(404, 'text/plain', b'Not found\n')
+        if self.daemon.state is None:
+            return self.send_body(503, 'text/plain', b'The first inventory is being collected\n', {'Retry-After': '30'})
+        fmt = params.get('format', 'json')
+        if fmt not in self.daemon.FORMATS:
+            return self.send_body(400, 'text/plain', b'format must be one of: json, jsonl, csv\n')
+        try:
+            body, etag = self.daemon.render(fmt, params.get('filter', ''), params.get('exclude', ''))
+        except (ValueError, KeyError) as e:
+            return self.send_body(400, 'text/plain', ('Bad filter/exclude: ' + str(e) + '\n').encode('UTF-8'))
+        headers = {'ETag': etag, 'Last-Modified': self.date_time_string(self.daemon.state.generated)}
+        if etag in [ tag.strip() for tag in self.headers.get('If-None-Match', '').split(',') ]:
+            return self.send_body(304, None, b'', headers)
+        self.send_body(200, self.daemon.FORMATS[fmt], body, headers)
+
+    def send_body(self, code, ctype, body, headers=None):
+        self.send_response(code)
+        if ctype is not None:
+            self.send_header('Content-Type', ctype)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if code != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if code != 304:
+            self.wfile.write(body)
@@ -4,6 +4,8 @@
 # Run with:
 #   export PROMCRED=<user>:<password>
 #   python collect-from-prometheus.py -v -v  -u https://your-prometheus-1  -v --hide-ignored
+# or, to keep serving it over HTTP (see PrometheusInventoryDaemon):
+#   python collect-from-prometheus.py -u https://your-prometheus-1 --hide-ignored --serve :9123 --refresh-interval 3600
 #
 # (c) 2019, Nuno Tavares <n.tavares@portavita.eu>
 #
@@ -12,6 +14,10 @@ from PrometheusInventory import PrometheusInventory
 
 if __name__ == "__main__":
     ARGS = PrometheusInventory.parse_options()
+    if ARGS.serve:
+        from PrometheusInventoryDaemon import InventoryDaemon
+        InventoryDaemon(ARGS).serve()
+        exit(0)
     runner = PrometheusInventory(ARGS)
     runner.run()
     runner.print_results()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+#
+# Time to snapshot an inventory of N rows and to diff it against a previous snapshot where 1% of the rows were
+# changed, 1% removed and 1% added, for a growing N (it should grow linearly).
+#
+# Run with:
+#   python tests/bench_diff.py [<rows>]
+#
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import test_common
+from PrometheusInventory import PrometheusInventory, InventoryDB, InventoryRecord
+
+
+def fill(runner, rows, generation):
+    runner.DB = InventoryDB()
+    for i in range(rows):
+        if generation and i % 97 == 1:
+            continue
+        r = InventoryRecord('Disk', 'location', [ 'disk:rule%d' % (i % 20), 'smartmon_device_info' ])
+        r['brand'] = 'HP'
+        r['model'] = 'EG0900' if not (generation and i % 97 == 2) else 'EG1200'
+        r['serial'] = '%s%08d' % ('N' if generation and i % 97 == 3 else 'S', i)
+        r['location'] = 'host%05d' % (i // 8)
+        r.extra.append('slot %d' % (i % 8))
+        runner.DB.append(r)
+
+
+def main():
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = tempfile.mkdtemp()
+    try:
+        for rows in [ top // 4, top // 2, top ]:
+            options = test_common.TestContextOffline().get_options()
+            options.debug = 0
+            runner = PrometheusInventory(options)
+            path = os.path.join(tmp, 'snapshot')
+            fill(runner, rows, 0)
+            start = time.perf_counter()
+            runner.save_snapshot(path)
+            saved = time.perf_counter() - start
+            fill(runner, rows, 1)
+            start = time.perf_counter()
+            changes = list(runner.diff_snapshot(path))
+            diffed = time.perf_counter() - start
+            print('rows=%7d  snapshot=%.3fs  diff=%.3fs (%d changes)' % (rows, saved, diffed, len(changes)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
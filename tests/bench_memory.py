@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# Peak memory (tracemalloc) and time of a full run of the 'memory' rule against a local HTTP server serving a
+# synthetic node_dmi_memory_device response, with and without --stream.
+#
+# Run with:
+#   python tests/bench_memory.py [<hosts> [<dimms per host>]]
+#
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import test_common
+from PrometheusInventory import PrometheusInventory
+
+
+def make_response(hosts, dimms):
+    result = []
+    for h in range(hosts):
+        for d in range(dimms):
+            result += [ {'metric': {'__name__': 'node_dmi_memory_device', 'instance': 'host%05d.example.net:9100' % h,
+                                    'job': 'node', 'hostname': 'host%05d' % h, 'manufacturer': 'Samsung',
+                                    'partnumber': 'M393A4K40CB2-CTD', 'serialnumber': '%08X' % (h * dimms + d),
+                                    'formfactor': 'DIMM', 'type': 'DDR4', 'speed': '2666 MT/s', 'size': '32 GB',
+                                    'locator': 'DIMM_%s%d' % ('ABCD'[d % 4], d), 'bank_locator': 'BANK %d' % d,
+                                    'asset_tag': 'Not Specified', 'rank': '2', 'configured_voltage': '1.2 V'},
+                         'value': [ time.time(), '1' ]} ]
+    return json.dumps({'status': 'success', 'data': {'resultType': 'vector', 'result': result}}).encode('UTF-8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    payload = b''
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+
+def bench(url, stream):
+    options = test_common.TestContextOffline().get_options()
+    options.config = './configmap-prom-inventory.yaml'
+    options.debug = 0
+    options.prom_endpoint = url
+    options.exception = ''
+    options.only = 'memory'
+    options.stream = stream
+    runner = PrometheusInventory(options)
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    runner.run()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - base
+    return len(runner.DB), elapsed, peak
+
+
+if __name__ == "__main__":
+    hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    dimms = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    Handler.payload = make_response(hosts, dimms)
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d' % server.server_port
+    print('response: %d series, %.1f MB' % (hosts * dimms, len(Handler.payload) / 1024.0 / 1024.0))
+    tracemalloc.start()
+    print('%-10s %8s %10s %12s' % ('mode', 'rows', 'time (s)', 'peak (MB)'))
+    for mode, stream in [ ('default', False), ('--stream', True) ]:
+        rows, elapsed, peak = bench(url, stream)
+        print('%-10s %8d %10.2f %12.1f' % (mode, rows, elapsed, peak / 1024.0 / 1024.0))
+    server.shutdown()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Measures what --project-labels saves: for each recorded fixture (tests/data/<metric>.json, the response of the
+# plain query), builds the response Prometheus would send for the projected 'count by (...)' query of the same
+# metric, and compares payload size and decode time of both. Metrics without a fixture are taken from a synthetic fleet
+# of FLEET_HOSTS hosts (tests/fleet.py), as test_offline.py does.
+#
+# Run with:
+#   python tests/bench_projection.py [<data folder> [<config>]]
+#
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fleet
+import test_common
+from PrometheusInventory import PrometheusInventory
+
+FLEET_HOSTS = 1000
+
+
+def project(rj, labels):
+    counts = {}
+    for row in rj['data']['result']:
+        key = tuple([ (l, row['metric'][l]) for l in labels if l in row['metric'] ])
+        counts[key] = counts.get(key, 0) + 1
+    result = [ {'metric': dict(key), 'value': [ time.time(), str(count) ]} for key, count in counts.items() ]
+    return {'status': 'success', 'data': {'resultType': 'vector', 'result': result}}
+
+
+def load(datadir, metric, responses):
+    """ The plain response for metric: its fixture in datadir, or else the one of the synthetic fleet (None if neither) """
+    path = os.path.join(datadir, metric + '.json')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    if metric in responses:
+        return json.dumps(responses[metric]).encode('UTF-8')
+    return None
+
+
+def decode_time(payload, expand=False, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        rj = json.loads(payload.decode('UTF-8'))
+        if expand:
+            PrometheusInventory.expand_counts(rj)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    datadir = sys.argv[1] if len(sys.argv) > 1 else './tests/data'
+    options = test_common.TestContextOffline().get_options()
+    options.config = sys.argv[2] if len(sys.argv) > 2 else './configmap-prom-inventory.yaml'
+    options.debug = 0
+    options.project_labels = True
+    runner = PrometheusInventory(options)
+    runner.load_config()
+    runner.plan_queries(runner.RULES)
+
+    print('%-28s %8s %12s %12s %10s %10s' % ('metric', 'series', 'plain (B)', 'projected', 'plain (s)', 'projected'))
+    totals = [ 0, 0, 0.0, 0.0 ]
+    responses = fleet.generate(FLEET_HOSTS)
+    for metric, query in sorted(runner.QUERIES.items()):
+        plain = load(datadir, metric, responses) if query in runner.PROJECTED else None
+        if plain is None:
+            continue
+        labels = query[len('count by ('):query.index(')')].split(',')
+        projected = json.dumps(project(json.loads(plain.decode('UTF-8')), labels)).encode('UTF-8')
+        stats = [ len(plain), len(projected), decode_time(plain), decode_time(projected, True) ]
+        totals = [ t + v for t, v in zip(totals, stats) ]
+        print('%-28s %8d %12d %12d %10.4f %10.4f' % tuple([ metric, len(json.loads(plain)['data']['result']) ] + stats))
+    print('%-28s %8s %12d %12d %10.4f %10.4f' % tuple([ 'total', '' ] + totals))
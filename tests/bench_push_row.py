@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark for PrometheusInventory.push_row(): inserting N rows with collisions: override,
+# into a plain list (linear scan, as before) and into an InventoryDB (hash indexed).
+#
+# Run with:
+#   python tests/bench_push_row.py [<rows> ...]
+#
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import test_common
+from PrometheusInventory import PrometheusInventory, InventoryDB
+
+
+def make_rows(count):
+    # memory-like rows: 8 DIMMs per host sharing type/model/location, half of them without a serial,
+    # and a second source filling in the missing serials of one out of four hosts
+    rows = []
+    for i in range(count):
+        host = 'host%05d' % (i // 8)
+        serial = '' if i % 2 else 'SN%08d' % i
+        if (i // 8) % 4 == 3 and i % 2:
+            serial = 'LATE%08d' % i
+        rows += [ {'type': 'Memory', 'brand': 'Samsung', 'model': 'M393A2K40', 'serial': serial, 'location': host,
+                   'extra': [], 'sources': [ 'memory' ], 'collisions': 'override'} ]
+    return rows
+
+
+def bench(runner, rows, targetDb):
+    start = time.perf_counter()
+    for r in rows:
+        runner.push_row(dict(r), targetDb)
+    return time.perf_counter() - start, len(targetDb)
+
+
+if __name__ == "__main__":
+    sizes = [ int(a) for a in sys.argv[1:] ] or [ 1000, 2000, 4000, 8000, 16000 ]
+    options = test_common.TestContextOffline().get_options()
+    options.debug = 0
+    runner = PrometheusInventory(options)
+    print('%8s %12s %12s %8s' % ('rows', 'list (s)', 'indexed (s)', 'speedup'))
+    for size in sizes:
+        rows = make_rows(size)
+        tlinear, nlinear = bench(runner, rows, [])
+        tindexed, nindexed = bench(runner, rows, InventoryDB())
+        assert nlinear == nindexed
+        print('%8d %12.4f %12.4f %7.1fx' % (size, tlinear, tindexed, tlinear / tindexed))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+#
+# Memory (tracemalloc) and time of building N inventory rows as plain dicts, as the engine did before, and as
+# InventoryRecord, then pushing them into an InventoryDB.
+#
+# Run with:
+#   python tests/bench_records.py [<rows>]
+#
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import test_common
+from PrometheusInventory import PrometheusInventory, InventoryRecord
+
+
+def as_dict(i):
+    return {'type': 'Memory', 'brand': 'Samsung', 'model': 'M393A4K40CB2-CTD', 'serial': '%08X' % i,
+            'location': 'host%05d' % (i // 16), 'extra': [ 'DIMM_%d' % (i % 16) ],
+            'sources': [ 'memory', 'node_dmi_memory_device' ], 'collisions': 'serial'}
+
+
+def as_record(i):
+    r = InventoryRecord('Memory', 'serial')
+    r['brand'] = 'Samsung'
+    r['model'] = 'M393A4K40CB2-CTD'
+    r['serial'] = '%08X' % i
+    r['location'] = 'host%05d' % (i // 16)
+    r.extra.append('DIMM_%d' % (i % 16))
+    r['sources'] = [ 'memory', 'node_dmi_memory_device' ]
+    return r
+
+
+def measure(rows, make):
+    runner = PrometheusInventory(test_common.TestContextOffline().get_options())
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(rows):
+        runner.push_row(make(i), runner.DB)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak, elapsed
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, make in [ ('dict', as_dict), ('InventoryRecord', as_record) ]:
+        current, peak, elapsed = measure(rows, make)
+        print('%-16s rows=%d  retained=%6.1f MiB  peak=%6.1f MiB  %.2fs' % (name, rows, current / 2**20, peak / 2**20, elapsed))
+
+
+if __name__ == '__main__':
+    main()
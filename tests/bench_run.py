@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# End to end benchmark: PrometheusInventory.run() and print_results() with configmap-prom-inventory.yaml over
+# synthetic fleets (tests/fleet.py) of growing size. Prints, per fleet size, the time of each phase of run() (as
+# reported by --profile), the time to write the output, the rows and the peak memory (tracemalloc, on a second run).
+#
+# Responses are served from memory (offline, as tests/test_offline.py does) or, with --http, by a local
+# tests/stub_prometheus.py server, so that the network path (session, gzip, decoding) is measured as well.
+# Any other argument is passed on to PrometheusInventory, e.g.:
+#   python tests/bench_run.py --hosts 100,1000,10000 --http -- --stream --output csv
+#
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fleet
+from stub_prometheus import StubPrometheus
+from PrometheusInventory import PrometheusInventory
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'configmap-prom-inventory.yaml')
+
+
+class NullWriter(object):
+    """ Counts what print_results() writes """
+    size = 0
+
+    def write(self, s):
+        self.size += len(s)
+
+    def flush(self):
+        pass
+
+
+def collect(responses, url, args):
+    options = PrometheusInventory.parse_options([ '--config', CONFIG, '-u', url, '--profile' ] + args)
+    runner = PrometheusInventory(options)
+    if url == 'offline':
+        empty = {'status': 'success', 'data': {'resultType': 'vector', 'result': []}}
+        runner.get_results = lambda entry, endpoint=None: responses.get(entry['metric'], empty)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stderr, sys.stderr = sys.stderr, devnull
+        try:
+            runner.run()
+        finally:
+            sys.stderr = stderr
+    elapsed = time.perf_counter() - start
+    out = NullWriter()
+    start = time.perf_counter()
+    runner.print_results(out)
+    return runner, elapsed, time.perf_counter() - start, out.size
+
+
+def main():
+    PARSER = argparse.ArgumentParser(description='End to end benchmark over synthetic fleets')
+    PARSER.add_argument('--hosts', default='100,1000,10000', help='Fleet sizes, comma separated (up to 50000 is realistic)')
+    PARSER.add_argument('--seed', default=0, type=int)
+    PARSER.add_argument('--http', default=False, action='store_true', help='Query a local stub server instead of mocking get_results()')
+    PARSER.add_argument('--no-memory', default=False, action='store_true', help='Skip the (slower) second run measuring peak memory')
+    PARSER.add_argument('args', nargs='*', help='PrometheusInventory options (after --)')
+    ARGS = PARSER.parse_args()
+
+    for hosts in [ int(h) for h in ARGS.hosts.split(',') ]:
+        responses = fleet.generate(hosts, ARGS.seed)
+        server = None
+        url = 'offline'
+        if ARGS.http:
+            server = StubPrometheus(responses).start()
+            url = StubPrometheus.get_url(server)
+        try:
+            runner, elapsed, printed, size = collect(responses, url, ARGS.args)
+            peak = None
+            if not ARGS.no_memory:
+                tracemalloc.start()
+                collect(responses, url, ARGS.args)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        phases = ' '.join([ '%s=%.2fs' % (phase, t) for phase, t in runner.get_profile()['phases'].items() ])
+        print('hosts=%-6d series=%-8d rows=%-7d run=%.2fs (%s) output=%.2fs (%d chars)%s' % (
+            hosts, sum([ len(rj['data']['result']) for rj in responses.values() ]), len(runner.DB), elapsed, phases,
+            printed, size, '' if peak is None else '  peak=%.1f MiB' % (peak / 2**20)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark for InventoryDB.select(): repeated lookups ("all disks at host X", "where is serial Y", "memory of
+# some brands at host X") over the DB of a synthetic fleet (tests/fleet.py), with a linear scan of every row (as
+# get_filtered_results() did) and with select() and its secondary indexes (built by the first lookup).
+#
+# Run with:
+#   python tests/bench_select.py [<hosts> [<lookups>]]
+#
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fleet
+import test_common
+from PrometheusInventory import PrometheusInventory, InventoryDB
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'configmap-prom-inventory.yaml')
+EMPTY = {'status': 'success', 'data': {'resultType': 'vector', 'result': []}}
+
+
+def scan(db, include, exclude):
+    return [ r for r in db if all([ InventoryDB.matches(r[f], p) for f, p in include.items() ])
+             and not any([ InventoryDB.matches(r[f], p) for f, p in exclude.items() ]) ]
+
+
+def lookups(db, count):
+    rnd = random.Random(0)
+    rows = list(db)
+    queries = []
+    for i in range(count):
+        r = rnd.choice(rows)
+        queries += [ ({'type': 'Disk', 'location': r['location']}, {}), ({'serial': r['serial']}, {}),
+                     ({'location': r['location'], 'brand': ('Samsung', 'Micron')}, {'type': 'Disk'}) ][i % 3:i % 3 + 1]
+    return queries
+
+
+if __name__ == "__main__":
+    hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    options = test_common.TestContextOffline().get_options()
+    options.debug = 0
+    options.config = CONFIG
+    options.exception = ''
+    runner = PrometheusInventory(options)
+    responses = fleet.generate(hosts)
+    runner.get_results = lambda entry, endpoint=None: responses.get(entry['metric'], EMPTY)
+    runner.run()
+    queries = lookups(runner.DB, count)
+    start = time.perf_counter()
+    expected = [ scan(runner.DB, include, exclude) for include, exclude in queries ]
+    tscan = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [ runner.DB.select(include, exclude) for include, exclude in queries ]
+    tselect = time.perf_counter() - start
+    assert found == expected
+    print('%d rows, %d lookups: scan %.4fs, select %.4fs (%.1fx)' % (len(runner.DB), count, tscan, tselect, tscan / tselect))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Startup benchmark: what a short invocation (cron, Kubernetes jobs, --only <rule>) pays before it queries anything.
+# Prints, as the best of some runs in fresh interpreters: the time to import PrometheusInventory (and which of the
+# heavy modules it loaded), load_config() parsing configmap-prom-inventory.yaml and load_config() reusing the rules file
+# parsed in --cache-dir, and a whole collect-from-prometheus.py --only <rule> --offline --output csv.
+#
+# Run with:
+#   python tests/bench_startup.py [<runs>]
+#
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CONFIG = os.path.join(ROOT, 'configmap-prom-inventory.yaml')
+HEAVY = [ 'requests', 'urllib3', 'prettytable', 'yaml', 'pprint', 'multiprocessing' ]
+
+IMPORT = """
+import sys, time
+sys.path.insert(0, %r)
+start = time.perf_counter()
+import PrometheusInventory
+elapsed = time.perf_counter() - start
+print(elapsed, ','.join([ m for m in %r if m in sys.modules ]))
+""" % (ROOT, HEAVY)
+
+LOAD_CONFIG = """
+import sys, time
+sys.path.insert(0, %r)
+from PrometheusInventory import PrometheusInventory
+options = PrometheusInventory.parse_options([ '--config', %r, '--cache-dir', sys.argv[1] ])
+runner = PrometheusInventory(options)
+start = time.perf_counter()
+runner.load_config()
+print(time.perf_counter() - start, len(runner.RULES))
+"""
+
+
+def run(args):
+    return subprocess.run([ sys.executable ] + args, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+
+
+def best(runs, args):
+    return min([ float(run(args)[0]) for i in range(runs) ])
+
+
+def wall(runs, args):
+    import time
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([ sys.executable ] + args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times += [ time.perf_counter() - start ]
+    return min(times)
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    cachedir = tempfile.mkdtemp()
+    try:
+        loaded = run([ '-c', IMPORT ])[1:]
+        print('import PrometheusInventory   %.4fs  (loaded: %s)' % (best(runs, [ '-c', IMPORT ]), loaded[0] if loaded else 'none of ' + ','.join(HEAVY)))
+        nocache = tempfile.mkdtemp()
+        try:
+            # a new cache dir each time: the rules file is always parsed and compiled
+            parsed = min([ float(run([ '-c', LOAD_CONFIG % (ROOT, CONFIG), tempfile.mkdtemp(dir=nocache) ])[0]) for i in range(runs) ])
+        finally:
+            shutil.rmtree(nocache)
+        print('load_config() parsed        %.4fs' % parsed)
+        run([ '-c', LOAD_CONFIG % (ROOT, CONFIG), cachedir ])
+        print('load_config() cached        %.4fs' % best(runs, [ '-c', LOAD_CONFIG % (ROOT, CONFIG), cachedir ]))
+        print('collect --only servers      %.4fs  (--offline --output csv, wall time)' % wall(runs, [
+            os.path.join(ROOT, 'collect-from-prometheus.py'), '--config', CONFIG, '-u', 'http://localhost:9090', '--only', 'servers',
+            '--offline', '--cache-dir', cachedir, '--output', 'csv' ]))
+    finally:
+        shutil.rmtree(cachedir)
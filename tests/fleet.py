@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# Synthetic fleet: Prometheus instant-query responses for every metric used by configmap-prom-inventory.yaml, for
+# a fleet of the given number of hosts, with the racks' switches (entPhysical* series, including their SFPs), UPSes
+# and PDUs. The same hosts and seed always give the same responses.
+#
+# Write them as tests/data-like <metric>.json files with:
+#   python tests/fleet.py <folder> [<hosts> [<seed>]]
+#
+import json
+import os
+import random
+import sys
+
+HOSTS_PER_RACK = 20
+RACKS_PER_UPS = 10
+TIMESTAMP = 1600000000.0
+
+SERVERS = [
+    ('Dell Inc.', [ 'PowerEdge R640', 'PowerEdge R740', 'PowerEdge R740xd' ]),
+    ('HPE', [ 'ProLiant DL360 Gen10', 'ProLiant DL380 Gen10' ]),
+    ('Supermicro', [ 'SYS-1029P-WTR', 'SYS-6019U-TR4' ]),
+]
+DIMMS = [ ('Samsung', 'M393A4K40CB2-CTD', '32 GB'), ('Micron', '36ASF4G72PZ-2G9E2', '32 GB'), ('Hynix', 'HMA82GR7CJR8N-VK', '16 GB') ]
+DISKS = [ 'SEAGATE ST900MM0168', 'TOSHIBA AL15SEB120N', 'HGST HUC101818CS4200', 'ST930060 3SE0KX8X', 'WDC WD4002FYYZ' ]
+ARISTA_MODELS = [ 'DCS-7050SX-64', 'DCS-7280SR-48C6', 'DCS-7010T-48' ]
+SFP_MODELS = [ ('Arista Networks', 'SFP-10G-SR'), ('Arista Networks', 'SFP-10G-LR'), ('FINISAR CORP.', 'FTLX8571D3BCL') ]
+
+
+def series(metric, **labels):
+    labels.update({'__name__': metric})
+    return {'metric': labels, 'value': [ TIMESTAMP, '1' ]}
+
+
+class Fleet(object):
+    """
+    Builds the series of a fleet of hosts, racks of HOSTS_PER_RACK hosts each having a switch and two PDUs, and a UPS
+    every RACKS_PER_UPS racks. The first Arista switch is a DCS-7048T-A, the only one (tests/test_offline.py counts it).
+    """
+
+    def __init__(self, hosts, seed=0):
+        self.hosts = hosts
+        self.rnd = random.Random(seed)
+        self.result = {}
+        self.serial = 0
+
+    def add(self, metric, **labels):
+        labels.setdefault('instance', labels['hostname'] + (':9100' if metric.startswith(('node_', 'megaraid', 'hpsa', 'tw_cli', 'smartmon')) else ''))
+        labels.setdefault('job', 'node' if labels['instance'].endswith(':9100') else 'snmp')
+        self.result.setdefault(metric, []).append(series(metric, **labels))
+
+    def next_serial(self, prefix):
+        self.serial += 1
+        return '%s%07d' % (prefix, self.serial)
+
+    def generate(self):
+        for h in range(self.hosts):
+            self.add_server('srv%05d' % h)
+        racks = max(1, (self.hosts + HOSTS_PER_RACK - 1) // HOSTS_PER_RACK)
+        for r in range(racks):
+            self.add_switch('sw%04d' % r, r)
+            for p in range(2):
+                self.add_pdu('pdu%04d-%d' % (r, p))
+            if r % RACKS_PER_UPS == 0:
+                self.add_ups('ups%04d' % (r // RACKS_PER_UPS))
+        # rules ignore these, by hostname
+        self.add('entPhysicalSerialNum', hostname='some-switches-to-ignore', entPhysicalIndex='1', entPhysicalSerialNum=self.next_serial('X'),
+                 entPhysicalDescr='DCS chassis', entPhysicalName='Switch', entPhysicalModelName='DCS-7010T-48', entPhysicalMfgName='Arista Networks')
+        return dict([ (metric, {'status': 'success', 'data': {'resultType': 'vector', 'result': result}}) for metric, result in self.result.items() ])
+
+    def add_server(self, host):
+        rnd = self.rnd
+        brand, models = rnd.choice(SERVERS)
+        self.add('node_dmi_hardware_info', hostname=host, manufacturer=brand, productname=rnd.choice(models),
+                 serialnumber=self.next_serial('SN'), biosversion='2.%d.1' % rnd.randint(0, 9))
+        manufacturer, partnumber, size = rnd.choice(DIMMS)
+        slots = rnd.choice([ 12, 16, 24 ])
+        for s in range(slots):
+            populated = s < slots * 2 // 3
+            self.add('node_dmi_memory_device', hostname=host, locator='DIMM_%s%d' % ('ABCD'[s % 4], s // 4),
+                     manufacturer=manufacturer if populated else 'Not Specified', partnumber=partnumber if populated else 'NO DIMM',
+                     serialnumber=self.next_serial('M') if populated else '', formfactor='DIMM', type='DDR4',
+                     speed='2666 MT/s' if populated else 'Unknown', size=size if populated else 'No Module Installed')
+        controller = rnd.random()
+        disks = rnd.randint(2, 8)
+        if controller < 0.6:
+            self.add('megaraid_controller_info', hostname=host, model='PERC H730P Mini', serial=self.next_serial('CR'), controller='0')
+            self.add('megaraid_cv_info', hostname=host, manufacturer='LSI', type='CVPM02', serial=self.next_serial('CV'), controller='0')
+            for d in range(disks):
+                model = rnd.choice(DISKS)
+                serial = self.next_serial('D')
+                self.add('megaraid_pd_info', hostname=host, model=model, serial=serial, media='HDD', interface='SAS',
+                         enclosure='32', slot=str(d))
+                self.add('smartmon_device_info', hostname=host, type='megaraid,%d' % d, serial_number=serial,
+                         device_model=model, disk='/dev/bus/0')
+        elif controller < 0.9:
+            self.add('hpsa_controller_info', hostname=host, model='Smart Array P408i-a SR Gen10', serial=self.next_serial('PE'))
+            self.add('hpsa_cache_info', hostname=host, serial=self.next_serial('PB'), size='2 GB')
+            for d in range(disks):
+                self.add('hpsa_physicaldrive_info', hostname=host, model='HP EG0900JFCKB', serial=' ' + self.next_serial('H') + ' ',
+                         speed='10000', bay=str(d + 1))
+            self.add('smartmon_device_info', hostname=host, type='scsi', serial_number=self.next_serial('PE'), device_model='HP LOGICAL VOLUME')
+        else:
+            self.add('tw_cli_controller_info', hostname=host, model='9650SE-4LPML', serial=self.next_serial('L'))
+            self.add('tw_cli_bbu_info', hostname=host, serial=self.next_serial('LB'))
+            for d in range(disks):
+                self.add('tw_cli_drive_info', hostname=host, model=rnd.choice(DISKS), serial=self.next_serial('T'), port=str(d))
+                self.add('smartmon_device_info', hostname=host, type='3ware,%d' % d, serial_number=self.next_serial('T'), device_model='')
+
+    def add_switch(self, host, rack):
+        rnd = self.rnd
+        kind = rnd.random()
+        if rack % 25 == 1:
+            self.add('sysDescr', hostname=host, sysDescr='Supermicro Switch SSE-G2252')
+        elif rack == 0 or kind < 0.7:
+            model = 'DCS-7048T-A' if rack == 0 else rnd.choice(ARISTA_MODELS)
+            self.add_entity(host, '1', self.next_serial('JPE'), 'Arista Networks', model, 'DCS chassis', 'Switch')
+            for port in range(rnd.randint(4, 48)):
+                mfg, sfp = rnd.choice(SFP_MODELS)
+                self.add_entity(host, str(100011 + port * 100), self.next_serial('XCV'), mfg, sfp,
+                                'Xcvr for Ethernet%d' % (port + 1), 'Ethernet%d' % (port + 1))
+        elif kind < 0.9:
+            self.add_entity(host, '1', self.next_serial('CN'), 'HP', 'HP V1910-48G Switch JE009A', 'HP V1910 Switch', 'V1910')
+            for port in range(51, 53):
+                self.add_entity(host, str(port + 1), self.next_serial('SF'), 'HP', 'JD118B', 'SFP', 'GigabitEthernet1/0/%d' % port)
+        else:
+            self.add_entity(host, '67108992', self.next_serial('CN'), 'Dell', 'PowerConnect 5548', 'PowerConnect 5548', 'Unit 1')
+
+    def add_entity(self, host, index, serial, mfg, model, descr, name):
+        self.add('entPhysicalSerialNum', hostname=host, entPhysicalIndex=index, entPhysicalSerialNum=serial, entPhysicalDescr=descr,
+                 entPhysicalName=name, entPhysicalModelName=model, entPhysicalMfgName=mfg)
+        self.add('entPhysicalMfgName', hostname=host, entPhysicalIndex=index, entPhysicalMfgName=mfg)
+        self.add('entPhysicalModelName', hostname=host, entPhysicalIndex=index, entPhysicalModelName=model)
+
+    def add_pdu(self, host):
+        self.add('rPDU2IdentSerialNumber', hostname=host, rPDU2IdentSerialNumber=self.next_serial('ZA'))
+        self.add('rPDU2IdentModelNumber', hostname=host, rPDU2IdentModelNumber=self.rnd.choice([ 'AP8853', 'AP8959EU3' ]))
+
+    def add_ups(self, host):
+        self.add('upsAdvIdentSerialNumber', hostname=host, upsAdvIdentSerialNumber=self.next_serial('AS'))
+        self.add('upsBasicIdentModel', hostname=host, upsBasicIdentModel='Smart-UPS SRT 6000')
+        self.add('upsAdvIdentSkuNumber', hostname=host, upsAdvIdentSkuNumber='SRT6KXLI')
+
+
+def generate(hosts, seed=0):
+    """ Returns { metric: Prometheus response } for a fleet of this many hosts """
+    return Fleet(hosts, seed).generate()
+
+
+def write(folder, responses):
+    os.makedirs(folder, exist_ok=True)
+    for metric, rj in responses.items():
+        with open(os.path.join(folder, metric + '.json'), 'w') as f:
+            json.dump(rj, f)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Usage: ' + sys.argv[0] + ' <folder> [<hosts> [<seed>]]')
+    write(sys.argv[1], generate(int(sys.argv[2]) if len(sys.argv) > 2 else 100, int(sys.argv[3]) if len(sys.argv) > 3 else 0))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+#
+# A local stand-in for the Prometheus HTTP API, serving fixed responses (tests/fleet.py or tests/data-like folders)
+# to /api/v1/query. It evaluates the queries PrometheusInventory sends: instant vector selectors with label matchers
+# (metric{label="v",label=~"re",...} or {__name__=~"..."}), count by (...) (...) over them, and the
+# last_over_time(timestamp(...)[<w>s:<step>s] offset <o>s) of --lookback. Series are there at the time of their
+# sample: an instant query only returns those sampled in the last STALENESS seconds before the stub's now. With
+# max_samples, queries selecting more series than that fail as Prometheus' query.max-samples limit does (422).
+#
+# Serve a synthetic fleet (or a folder of <metric>.json) with:
+#   python tests/stub_prometheus.py [--hosts <hosts> | --data <folder>] [--port <port>]
+#
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MATCHER = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*,?')
+SELECTOR = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)?\s*(?:\{(.*)\})?$', re.S)
+COUNT_BY = re.compile(r'^count\s+by\s*\(([^)]*)\)\s*\((.*)\)$', re.S)
+LAST_SEEN = re.compile(r'^last_over_time\(timestamp\((.*)\)\[(\d+)s:(\d+)s\](?:\s+offset\s+(\d+)s)?\)$', re.S)
+STALENESS = 300
+
+
+class TooManySamples(Exception):
+    pass
+
+
+class StubPrometheus(object):
+    """ The series of each metric (as { metric: response }) and the queries received so far """
+
+    def __init__(self, responses, now=None, max_samples=None):
+        self.series = dict([ (metric, rj['data']['result']) for metric, rj in responses.items() ])
+        self.queries = []
+        self.max_samples = max_samples
+        self.now = now
+        if self.now is None:
+            self.now = max([ float(s['value'][0]) for result in self.series.values() for s in result ] or [ 0 ])
+
+    @staticmethod
+    def parse_selector(query):
+        found = SELECTOR.match(query.strip())
+        if not found:
+            raise ValueError('unsupported query: ' + query)
+        matchers = []
+        body = found.group(2) or ''
+        pos = 0
+        while pos < len(body):
+            matcher = MATCHER.match(body, pos)
+            if not matcher:
+                raise ValueError('bad matcher: ' + body[pos:])
+            matchers += [ (matcher.group(1), matcher.group(2), json.loads('"' + matcher.group(3) + '"')) ]
+            pos = matcher.end()
+        if found.group(1):
+            matchers += [ ('__name__', '=', found.group(1)) ]
+        return matchers
+
+    @staticmethod
+    def matches(labels, matchers):
+        for label, op, value in matchers:
+            v = labels.get(label, '')
+            if op == '=' and v != value or op == '!=' and v == value:
+                return False
+            if op in [ '=~', '!~' ] and (re.fullmatch(value, v, re.S) is None) == (op == '=~'):
+                return False
+        return True
+
+    def select(self, matchers, start=None, end=None):
+        """ The series matching, with a sample between start and end (by default, not stale at now) """
+        if end is None:
+            start, end = self.now - STALENESS, self.now
+        names = [ value for label, op, value in matchers if label == '__name__' and op == '=' ]
+        metrics = names if names else list(self.series)
+        result = []
+        for metric in metrics:
+            result += [ s for s in self.series.get(metric, []) if start <= float(s['value'][0]) <= end and self.matches(s['metric'], matchers) ]
+        if self.max_samples is not None and len(result) > self.max_samples:
+            raise TooManySamples('query processing would load too many samples into memory in query execution')
+        return result
+
+    def evaluate(self, query):
+        lastseen = LAST_SEEN.match(query.strip())
+        if lastseen:
+            end = self.now - int(lastseen.group(4) or 0)
+            result = []
+            for s in self.select(self.parse_selector(lastseen.group(1)), end - int(lastseen.group(2)), end):
+                labels = dict([ (l, v) for l, v in s['metric'].items() if l != '__name__' ])
+                result += [ {'metric': labels, 'value': [ self.now, str(s['value'][0]) ]} ]
+            return result
+        counted = COUNT_BY.match(query.strip())
+        if counted:
+            by = [ label.strip() for label in counted.group(1).split(',') if label.strip() ]
+            groups = {}
+            for s in self.evaluate(counted.group(2)):
+                key = tuple([ (label, s['metric'][label]) for label in by if s['metric'].get(label, '') != '' ])
+                groups[key] = groups.get(key, 0) + 1
+            return [ {'metric': dict(key), 'value': [ 0, str(count) ]} for key, count in groups.items() ]
+        return self.select(self.parse_selector(query))
+
+    def start(self, port=0, host='127.0.0.1'):
+        """ Serves in a background thread, returns the server (its URL is get_url(server)) """
+        stub = self
+
+        class Handler(StubRequestHandler):
+            pass
+        Handler.stub = stub
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    @staticmethod
+    def get_url(server):
+        return 'http://%s:%d' % server.server_address[:2]
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        if url.path != '/api/v1/query' or 'query' not in params:
+            return self.send_json(404, {'status': 'error', 'errorType': 'not_found', 'error': url.path})
+        query = params['query'][0]
+        self.stub.queries += [ query ]
+        try:
+            result = self.stub.evaluate(query)
+        except TooManySamples as e:
+            return self.send_json(422, {'status': 'error', 'errorType': 'execution', 'error': str(e)})
+        except (ValueError, re.error) as e:
+            return self.send_json(400, {'status': 'error', 'errorType': 'bad_data', 'error': str(e)})
+        self.send_json(200, {'status': 'success', 'data': {'resultType': 'vector', 'result': result}})
+
+    def send_json(self, code, rj):
+        body = json.dumps(rj).encode('UTF-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def load(folder):
+    responses = {}
+    for filename in os.listdir(folder):
+        if filename.endswith('.json'):
+            with open(os.path.join(folder, filename)) as f:
+                responses[filename[:-5]] = json.load(f)
+    return responses
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Serves fixed responses as the Prometheus query API')
+    PARSER.add_argument('--hosts', default=100, type=int, help='Serve a synthetic fleet of this many hosts (tests/fleet.py)')
+    PARSER.add_argument('--data', default='', help='Serve the <metric>.json files of this folder instead')
+    PARSER.add_argument('--port', default=9090, type=int)
+    PARSER.add_argument('--max-samples', default=None, type=int, help='Fail queries selecting more series than this (422)')
+    ARGS = PARSER.parse_args()
+    if ARGS.data:
+        RESPONSES = load(ARGS.data)
+    else:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import fleet
+        RESPONSES = fleet.generate(ARGS.hosts)
+    SERVER = StubPrometheus(RESPONSES, max_samples=ARGS.max_samples).start(ARGS.port, '')
+    print('Serving ' + str(len(RESPONSES)) + ' metrics on ' + StubPrometheus.get_url(SERVER))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
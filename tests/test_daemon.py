@@ -0,0 +1,78 @@
+import json
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import test_common
+
+from nose.plugins.attrib import attr
+
+from PrometheusInventory import PrometheusInventory
+from PrometheusInventoryDaemon import InventoryDaemon
+
+
+def fake_run(failures):
+    def run(self):
+        for i, location in enumerate([ 'h1', 'h2', 'sw1' ]):
+            self.push_row({'type': 'Switch' if location == 'sw1' else 'Server', 'brand': 'Dell', 'model': 'R640',
+                           'serial': 'S%d' % i, 'location': location, 'extra': [], 'sources': [ location[:-1] ],
+                           'collisions': 'location'}, self.DB)
+        self.CACHE[('https://prometheus', 'up')] = {'status': 'success', 'data': {'result': []}}
+        self.LOOKUPS['serial'] = {}
+        self.FAILURES.update(failures)
+    return run
+
+
+@attr('offline')
+class PromInvDaemonTests(unittest.TestCase):
+    """
+    Tests for the HTTP daemon, with run() replaced by a fixed inventory
+    """
+
+    def setUp(self):
+        self.options = test_common.TestContextOffline().get_options()
+        self.options.debug = 0
+        self.options.serve = '127.0.0.1:0'
+        self.options.refresh_interval = 3600
+        self.daemon = InventoryDaemon(self.options)
+
+    def tearDown(self):
+        self.daemon.stop()
+
+    def get(self, path, headers=None):
+        host, port = self.daemon.server.server_address[:2]
+        request = urllib.request.Request('http://%s:%d%s' % (host, port, path), headers=headers or {})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, dict(response.headers), response.read().decode('UTF-8')
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), e.read().decode('UTF-8')
+
+    def test_refresh_keeps_last_complete_inventory(self):
+        with mock.patch.object(PrometheusInventory, 'run', fake_run({})):
+            self.assertTrue(self.daemon.refresh())
+        state = self.daemon.state
+        self.assertEqual(state.rows, {'h': 2, 'sw': 1})
+        self.assertEqual((state.runner.CACHE, state.runner.LOOKUPS, state.runner.FAILED_QUERIES), ({}, {}, {}))
+        with mock.patch.object(PrometheusInventory, 'run', fake_run({'entPhysicalSerialNum': 1})):
+            self.assertFalse(self.daemon.refresh())
+        self.assertIs(self.daemon.state, state)
+        metrics = self.daemon.get_metrics().decode('UTF-8')
+        self.assertIn('prometheus_inventory_refreshes_total{result="failure"} 1', metrics)
+        self.assertIn('prometheus_inventory_query_failures_total{metric="entPhysicalSerialNum"} 1', metrics)
+        self.assertIn('prometheus_inventory_rows{rule="h"} 2', metrics)
+
+    def test_inventory_endpoint(self):
+        with mock.patch.object(PrometheusInventory, 'run', fake_run({})):
+            self.daemon.refresh()
+        self.daemon.start(refresh=False)
+        code, headers, body = self.get('/inventory?filter=type=Server')
+        self.assertEqual(code, 200)
+        self.assertEqual([ r['location'] for r in json.loads(body) ], [ 'h1', 'h2' ])
+        code, headers, body = self.get('/inventory?filter=type=Server', {'If-None-Match': headers['ETag']})
+        self.assertEqual(code, 304)
+        code, headers, body = self.get('/inventory?exclude=type=Server&format=csv')
+        self.assertEqual(body.splitlines()[1:], [ 'Switch,Dell,R640,S2,sw1,,sw' ])
+        self.assertEqual(self.get('/inventory?filter=type')[0], 400)
+        self.assertEqual(self.get('/nothing')[0], 404)
@@ -0,0 +1,720 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fleet
+import test_common
+from stub_prometheus import StubPrometheus
+
+from nose.plugins.attrib import attr
+
+from PrometheusInventory import PrometheusInventory, InventoryDB, InventoryRecord
+
+
+def series(metric, **labels):
+    labels.update({'__name__': metric})
+    return {'metric': labels, 'value': [1600000000.0, '1']}
+
+
+def response(*result):
+    return {'status': 'success', 'data': {'resultType': 'vector', 'result': list(result)}}
+
+
+class TruncatedHandler(BaseHTTPRequestHandler):
+    """ Answers with half of the body its Content-Length announces, then hangs up """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps(response(series('node_dmi_hardware_info', hostname='a', serialnumber='1'))).encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2])
+        self.close_connection = True
+
+
+@attr('offline')
+class PromInvEngineTests(unittest.TestCase):
+    """
+    Tests for the building blocks of run(), fed with small inline datasets instead of tests/data
+    """
+
+    def setUp(self):
+        self.context = test_common.TestContextOffline()
+        self.options = self.context.get_options()
+        self.options.debug = 0
+        self.runner = PrometheusInventory(self.options)
+        self.queried = []
+        self.responses = {}
+
+    def tearDown(self):
+        if os.path.exists(self.options.config) and self.options.config.startswith(tempfile.gettempdir()):
+            os.unlink(self.options.config)
+
+    def mocked_get_results(self, entry, endpoint=None):
+        self.queried += [ entry['metric'] ]
+        if endpoint is not None and endpoint['url'] in self.responses:
+            return self.responses[endpoint['url']][entry['metric']]
+        return self.responses[entry['metric']]
+
+    def use_config(self, config):
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+            f.write(config)
+        self.options.config = f.name
+
+    def serve(self, stub, config=None):
+        """ Starts stub (a StubPrometheus) for this test and collects from it, with config or configmap-prom-inventory.yaml """
+        server = stub.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        if config is None:
+            self.options.config = './configmap-prom-inventory.yaml'
+            self.options.exception = ''
+        else:
+            self.use_config(config)
+        self.options.prom_endpoint = StubPrometheus.get_url(server)
+        return stub
+
+    def run_offline(self, responses):
+        """ A run with the same options, its results taken from responses ({ metric: response }) instead of Prometheus """
+        runner = PrometheusInventory(self.options)
+        runner.get_results = lambda entry, endpoint=None: responses.get(entry['metric'], response())
+        runner.run()
+        return runner
+
+    def assertSameRows(self, db, expected, ordered=True):
+        rows, expected = [ dict(r) for r in db ], [ dict(r) for r in expected ]
+        if not ordered:
+            key = lambda r: json.dumps(r, sort_keys=True, default=list)
+            rows, expected = sorted(rows, key=key), sorted(expected, key=key)
+        self.assertEqual(rows, expected)
+
+    def test_prefetch_queries_each_metric_once(self):
+        self.runner.get_results = self.mocked_get_results
+        self.responses = {
+            'entPhysicalSerialNum': response(),
+            'entPhysicalMfgName': response(),
+            'entPhysicalModelName': response(),
+        }
+        join = [ {'metric': 'entPhysicalMfgName', 'labels': {}, 'index': ['hostname']},
+                 {'metric': 'entPhysicalModelName', 'labels': {}, 'index': ['hostname']} ]
+        rules = [ {'name': 'a', 'metric': 'entPhysicalSerialNum', 'labels': {}, 'join': join},
+                  {'name': 'b', 'metric': 'entPhysicalSerialNum', 'labels': {}, 'join': join[:1]} ]
+        self.runner.prefetch([ self.runner.compile_rule(m) for m in rules ])
+        self.assertEqual(sorted(self.queried), sorted(self.responses.keys()))
+
+    def test_unreachable_endpoint_reports_status(self):
+        self.options.prom_endpoint = 'http://127.0.0.1:1'
+        self.options.retries = 0
+        self.options.connect_timeout = 1
+        rj = self.runner.get_results({'metric': 'up'})
+        self.assertTrue(rj['status'].startswith('request failed'))
+        self.assertTrue(self.runner.get_session() is self.runner.get_session())
+
+    def test_failed_queries_sent_once(self):
+        self.use_config(UPS_CONFIG)
+        self.options.prom_endpoint = 'http://127.0.0.1:1'
+        self.options.retries = 0
+        session = self.runner.get_session()
+        with unittest.mock.patch.object(session, 'get', wraps=session.get) as get:
+            errors = self.runner.run()
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(sorted(errors), [ 'ups', 'ups-again' ])
+        self.assertTrue(errors['ups'].startswith('Prometheus query failed for metric [upsAdvIdentSerialNumber]: request failed'))
+
+    def test_federation_merges_endpoints(self):
+        self.use_config(SERVERS_CONFIG)
+        self.runner.get_results = self.mocked_get_results
+        self.options.prom_endpoint = ['https://dc1', 'https://dc2']
+        self.responses = {
+            'https://dc1': {'node_dmi_hardware_info': response(series('node_dmi_hardware_info', hostname='a', serialnumber='1'))},
+            'https://dc2': {'node_dmi_hardware_info': response(series('node_dmi_hardware_info', hostname='b', serialnumber='2'))},
+        }
+        self.runner.run()
+        self.assertEqual([ (r['location'], r['sources'][-1]) for r in self.runner.DB ], [ ('a', 'https://dc1'), ('b', 'https://dc2') ])
+
+    def test_endpoints_are_validated(self):
+        self.options.prom_endpoint = None
+        self.assertRaises(ValueError, self.runner.run)
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('https://dc1 user:secret\nhttps://dc2 token\n')
+        self.addCleanup(os.unlink, f.name)
+        self.options.endpoints_file = f.name
+        self.assertRaises(ValueError, self.runner.get_endpoints)
+        with open(f.name, 'w') as f:
+            f.write('# dc1\nhttps://dc1/ user:se#cret  # behind the proxy\n  #https://dc2\n')
+        self.assertEqual(self.runner.get_endpoints(), [ {'url': 'https://dc1', 'auth': ('user', 'se#cret')} ])
+
+    def test_push_row_index_matches_linear_scan(self):
+        rows = []
+        for i in range(40):
+            rows += [ {'type': 'Disk', 'brand': ['', 'WD'][i % 2], 'model': 'M%d' % (i % 3), 'serial': ['', 'S%d' % i][i % 5 == 0],
+                       'location': 'h%d' % (i % 4), 'extra': [], 'sources': [ 'r%d' % i ], 'collisions': 'override'} ]
+        linear, indexed = [], InventoryDB()
+        for r in rows:
+            self.runner.push_row(dict(r, sources=list(r['sources'])), linear)
+            self.runner.push_row(dict(r, sources=list(r['sources'])), indexed)
+        self.assertEqual(linear, list(indexed))
+        del indexed[0]
+        self.assertEqual(sum([ len(v) for v in indexed.index.values() ]), len(indexed))
+
+    def test_select_with_indexes(self):
+        db = InventoryDB()
+        for i in range(40):
+            self.runner.push_row({'type': ['Disk', 'Memory'][i % 2], 'brand': ['', 'WD', 'HGST'][i % 3], 'model': 'M%d' % (i % 3),
+                                  'serial': 'S%d' % i, 'location': 'h%d' % (i % 4), 'extra': [], 'sources': [ 'r' ], 'collisions': 'override'}, db)
+        scan = lambda include, exclude: [ r for r in db if all([ InventoryDB.matches(r[f], p) for f, p in include.items() ])
+                                          and not any([ InventoryDB.matches(r[f], p) for f, p in exclude.items() ]) ]
+        queries = [ ({'type': 'Disk', 'location': 'h2'}, {}), ({'serial': 'S7'}, {}), ({'brand': ('WD', 'HGST'), 'type': 'Memory'}, {'location': 'h1'}),
+                    (PrometheusInventory.parse_filter('location~h[01]$,type=Disk|Memory'), PrometheusInventory.parse_filter('brand=')), ({}, {'type': 'Disk'}) ]
+        for include, exclude in queries:
+            self.assertEqual(db.select(include, exclude), scan(include, exclude))
+        self.assertEqual(sorted(db.indexes.keys()), [ 'brand', 'location', 'serial', 'type' ])
+        # merges change brand and serial in place
+        self.runner.push_row({'type': 'Disk', 'brand': 'Seagate', 'model': 'M0', 'serial': 'X', 'location': 'h0', 'extra': [], 'sources': [ 'late' ], 'collisions': 'override'}, db)
+        self.assertEqual([ r['serial'] for r in db.select({'brand': 'Seagate'}) ], [ 'S0' ])
+        db.append({'type': 'Disk', 'brand': 'Seagate', 'model': 'M9', 'serial': 'Y', 'location': 'h0', 'extra': [], 'sources': [], 'collisions': ''})
+        self.assertEqual([ r['serial'] for r in db.select({'brand': 'Seagate'}) ], [ 'S0', 'Y' ])
+        self.runner.DB = db
+        self.assertEqual(list(self.runner.get_filtered_results({'type': 'Memory'}, {'brand': ('', 'WD')})), db.select({'type': 'Memory', 'brand': 'HGST'}))
+        self.assertRaises(ValueError, PrometheusInventory.parse_filter, 'type')
+
+    def test_correlate_disks_by_serial(self):
+        self.runner.get_results = self.mocked_get_results
+        self.responses = {
+            'megaraid_pd_info': response(series('megaraid_pd_info', hostname='a', serial='wd-s1 ', model=''),
+                                         series('megaraid_pd_info', hostname='a', serial='S2', model='HGST X')),
+            'smartmon_device_info': response(series('smartmon_device_info', hostname='a', serial_number='S1', device_model='WDC WD4002'),
+                                             series('smartmon_device_info', hostname='a', serial_number='S2', device_model='HGST X'),
+                                             series('smartmon_device_info', hostname='b', serial_number='S2', device_model='HGST X'),
+                                             series('smartmon_device_info', hostname='a', serial_number='S3', device_model='HGST Y')),
+        }
+        self.use_config(DISKS_CONFIG)
+        self.options.exception = ''
+        self.runner.run()
+        self.assertEqual([ (r['location'], r['serial'], r['brand'], r['model'], r['sources']) for r in self.runner.DB ], [
+            ('a', 'wd-s1', 'WDC', 'WD4002', [ 'disk:megaraid', 'megaraid_pd_info', 'disk:smartmon', 'smartmon_device_info' ]),
+            ('a', 'S2', 'HGST', 'X', [ 'disk:megaraid', 'megaraid_pd_info', 'disk:smartmon', 'smartmon_device_info' ]),
+            ('b', 'S2', 'HGST', 'X', [ 'disk:smartmon', 'smartmon_device_info' ]),
+            ('a', 'S3', 'HGST', 'Y', [ 'disk:smartmon', 'smartmon_device_info' ]) ])
+        self.assertEqual(self.runner.DB.find_collisions(self.runner.DB[0]), [ self.runner.DB[0] ])
+        self.addCleanup(os.unlink, self.options.config)
+        self.use_config(DISKS_CONFIG.split('correlate:')[0])
+        self.runner.DB = InventoryDB()
+        self.runner.run()
+        self.assertEqual(len(self.runner.DB), 6)
+        self.assertEqual([ (location, serial, len(rows)) for location, serial, rows in self.runner.get_duplicates() ], [ ('a', 'S2', 2) ])
+
+
+    def test_correlated_fields_not_pushed_down(self):
+        self.use_config(DISKS_CONFIG)
+        self.runner.FILTER = {'model': 'WD4002'}
+        rule = self.runner.compile_rule({'name': 'disk:tw_cli', 'metric': 'tw_cli_disk_info', 'type': 'Disk', 'labels': {'model': 'model'}})
+        self.assertEqual(self.runner.get_matchers(rule, rule), [ 'model=~"(?s:.*)WD4002(?s:.*)"' ])
+        # correlate() may fill the model of the rows of rule in from smartmon rows
+        self.runner.load_config()
+        self.assertEqual(self.runner.get_pushdown_fields(), [ 'type', 'location' ])
+        self.assertEqual(self.runner.get_matchers(rule, rule), [])
+
+    def test_config_cache(self):
+        self.options.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.options.cache_dir)
+        self.use_config(DISKS_CONFIG)
+        self.runner.load_config()
+        self.assertEqual(len(os.listdir(self.options.cache_dir)), 1)
+        # data only, never anything to unpickle
+        with open(os.path.join(self.options.cache_dir, os.listdir(self.options.cache_dir)[0])) as f:
+            self.assertEqual(json.load(f)['map'], self.runner.MAP)
+        cached = PrometheusInventory(self.options)
+        with unittest.mock.patch.object(PrometheusInventory, 'parse_config', side_effect=AssertionError('parsed again')):
+            cached.load_config()
+            # same content, another mtime: the hash tells
+            os.utime(self.options.config, (0, 0))
+            cached.load_config()
+        self.assertEqual(cached.RULES, self.runner.RULES)
+        self.assertEqual(cached.CORRELATIONS, self.runner.CORRELATIONS)
+        self.assertEqual(cached.MAP, self.runner.MAP)
+        with open(self.options.config, 'w') as f:
+            f.write(DISKS_CONFIG.split('correlate:')[0])
+        cached.load_config()
+        self.assertEqual(cached.CORRELATIONS, [])
+
+    def test_compile_rule_leaves_config_untouched(self):
+        m = {'name': 'sfp', 'metric': 'entPhysicalSerialNum', 'labels': {'serial': 'entPhysicalSerialNum', 'brand': '_brand'},
+             'ignore_regexp': [ {'hostname': '^ignored$'}, {'entPhysicalSerialNum': None} ],
+             'join': [ {'metric': 'entPhysicalMfgName', 'labels': {'_brand': 'entPhysicalMfgName'}, 'index': ['hostname']} ]}
+        original = repr(m)
+        rule = self.runner.compile_rule(m)
+        self.assertEqual(repr(m), original)
+        self.assertEqual(rule['metric'], 'entPhysicalSerialNum')
+        self.assertRaises(KeyError, lambda: rule['labels'])
+        self.assertEqual((rule.get('name'), rule.get('labels', {})), ('sfp', {}))
+        self.assertTrue('join' in rule and 'labels' not in rule)
+        self.assertEqual(rule.join[0].fields, ('_brand', ))
+        self.assertEqual(rule.join[0].ignore, rule.ignore)
+        self.assertEqual(rule.labelmap['entPhysicalSerialNum'], (('serial', True), ))
+        self.assertTrue(self.runner.check_if_ignore({'hostname': 'ignored', 'entPhysicalSerialNum': 'x'}, rule))
+        self.assertTrue(self.runner.check_if_ignore({'hostname': 'other'}, rule))
+        self.assertFalse(self.runner.check_if_ignore({'hostname': 'other', 'entPhysicalSerialNum': 'x'}, rule))
+
+    def test_join_evaluated_once_for_all_fields(self):
+        self.use_config(UPS_CONFIG)
+        self.runner.get_results = self.mocked_get_results
+        self.responses = {
+            'upsAdvIdentSerialNumber': response(series('upsAdvIdentSerialNumber', hostname='ups1', upsAdvIdentSerialNumber='U1')),
+            'upsBasicIdentModel': response(series('upsBasicIdentModel', hostname='ups1', upsBasicIdentModel='Smart-UPS', upsBasicIdentName='APC')),
+        }
+        self.runner.run()
+        self.assertEqual(self.queried.count('upsBasicIdentModel'), 2) # prefetch + a single pass for both fields
+        self.assertEqual([ (r['sources'][0], r['model'], r['brand']) for r in self.runner.DB ], [ ('ups', 'Smart-UPS', 'APC'), ('ups-again', 'Smart-UPS', 'APC') ])
+
+    def test_failed_join_reported_by_each_rule(self):
+        self.use_config(UPS_CONFIG)
+        self.runner.get_results = self.mocked_get_results
+        self.responses = {'upsAdvIdentSerialNumber': response(series('upsAdvIdentSerialNumber', hostname='a', upsAdvIdentSerialNumber='1')),
+                          'upsBasicIdentModel': {'status': 'http code: 500'}}
+        error = 'Prometheus query failed for metric [upsBasicIdentModel]: http code: 500'
+        self.assertEqual(self.runner.run(), {'ups': error, 'ups-again': error})
+        self.assertEqual(self.runner.LOOKUPS, {})
+
+    def test_pushdown_matchers(self):
+        self.assertEqual(PrometheusInventory.promql_regexp('^scsi$'), '(?:^scsi$)(?s:.*)')
+        for pattern in [ '^(?!67108992)$', '^(1.+|(?!1.*))', '^\\D', '.*' ]:
+            self.assertTrue(PrometheusInventory.promql_regexp(pattern) is None)
+        rule = self.runner.compile_rule({'name': 'smart', 'metric': 'smartmon_device_info', 'type': 'Disk',
+                                         'labels': {'location': 'hostname', 'serial': 'serial_number'},
+                                         'ignore_regexp': [ {'type': '^scsi$'}, {'type': '^(?!sat)'}, {'serial_number': None} ]})
+        self.runner.FILTER = {'location': 'host1'}
+        self.runner.plan_queries([ rule ])
+        self.assertEqual(self.runner.get_query(rule), 'smartmon_device_info{type!~"(?:^scsi$)(?s:.*)",serial_number!="",hostname=~"(?s:.*)host1(?s:.*)"}')
+        self.runner.FILTER = {'type': 'Memory'}
+        self.assertTrue(self.runner.is_filtered_out(rule))
+        # series without the kind label are Servers too
+        rule = self.runner.compile_rule({'name': 'hosts', 'metric': 'node_dmi_hardware_info', 'type': 'Server', 'labels': {'type': 'kind'}})
+        self.runner.FILTER = {'type': 'Server'}
+        self.assertEqual(self.runner.get_matchers(rule, rule), [])
+        self.runner.FILTER = {'type': 'Switch'}
+        self.assertEqual(self.runner.get_matchers(rule, rule), [ 'kind=~"(?s:.*)Switch(?s:.*)"' ])
+
+    def test_label_projection(self):
+        self.options.project_labels = True
+        self.use_config(UPS_CONFIG)
+        self.runner.load_config()
+        self.runner.plan_queries(self.runner.RULES[:1])
+        self.assertEqual(self.runner.get_query(self.runner.RULES[0]), 'count by (_brand,_model,hostname,upsAdvIdentSerialNumber) (upsAdvIdentSerialNumber)')
+        self.assertEqual(self.runner.get_query(self.runner.RULES[0].join[0]), 'count by (hostname,upsBasicIdentModel,upsBasicIdentName) (upsBasicIdentModel)')
+        rj = PrometheusInventory.expand_counts(response({'metric': {'hostname': 'a'}, 'value': [ 0, '3' ]}))
+        self.assertEqual(rj['data']['result'], [ {'metric': {'hostname': 'a'}} ] * 3)
+
+    def test_disk_cache(self):
+        cachedir = tempfile.mkdtemp()
+        try:
+            self.options.cache_dir = cachedir
+            self.options.offline = True
+            self.options.prom_endpoint = 'https://your-prometheus-1.net'
+            entry = {'metric': 'node_dmi_hardware_info'}
+            path = self.runner.get_disk_cache_path(self.runner.get_endpoint(), 'node_dmi_hardware_info')
+            self.assertEqual(path, os.path.join(cachedir, 'your-prometheus-1.net', 'node_dmi_hardware_info.json'))
+            self.assertEqual(self.runner.get_results(entry)['status'], 'offline: no cached results')
+            # same format as the tests/data fixtures
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump(response(series('node_dmi_hardware_info', hostname='a')), f)
+            os.utime(path, (0, 0))
+            # --offline wins over --refresh
+            self.options.refresh = True
+            self.assertEqual(len(self.runner.get_results(entry)['data']['result']), 1)
+            self.options.refresh = False
+            self.options.offline = False
+            self.assertTrue(self.runner.get_disk_cache(self.runner.get_endpoint(), 'node_dmi_hardware_info') is None)
+            # expired, but better than nothing when Prometheus cannot be reached
+            self.options.prom_endpoint = 'http://127.0.0.1:1'
+            self.options.retries = 0
+            self.options.connect_timeout = 1
+            path = self.runner.get_disk_cache_path(self.runner.get_endpoint(), 'node_dmi_hardware_info')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump(response(series('node_dmi_hardware_info', hostname='a')), f)
+            os.utime(path, (0, 0))
+            self.assertEqual(len(PrometheusInventory(self.options).get_results(entry)['data']['result']), 1)
+            self.options.cache_max_size = 0
+            configcache = self.runner.get_config_cache_path(self.options.config)
+            with open(configcache, 'w') as f:
+                f.write('{}')
+            self.runner.evict_disk_cache()
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(configcache))
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_stream_truncated_response(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), TruncatedHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.options.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.options.cache_dir)
+        self.use_config(SERVERS_CONFIG)
+        self.options.prom_endpoint = 'http://127.0.0.1:%d' % server.server_address[1]
+        self.options.retries = 0
+        self.options.stream = True
+        errors = self.runner.run()
+        self.assertTrue(errors['servers'].startswith('Prometheus query failed for metric [node_dmi_hardware_info]: request failed'))
+        self.assertEqual([ f for d, dirs, files in os.walk(self.options.cache_dir) for f in files if f.endswith('.tmp') ], [])
+        # expired, but better than nothing
+        path = self.runner.get_disk_cache_path(self.runner.get_endpoint(), self.runner.get_query({'metric': 'node_dmi_hardware_info'}))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(response(series('node_dmi_hardware_info', hostname='b', serialnumber='2')), f)
+        os.utime(path, (0, 0))
+        runner = PrometheusInventory(self.options)
+        self.assertEqual(runner.run(), {})
+        self.assertEqual([ r['location'] for r in runner.DB ], [ 'b' ])
+
+    def test_stream_decode(self):
+        rj = response(series('node_dmi_memory_device', hostname='h\u00f6st', serialnumber='1', slot='A'),
+                      series('node_dmi_memory_device', hostname='host', serialnumber='2', slot='B'))
+        rj['warnings'] = [ 'result: [ not this one' ]
+        content = json.dumps(rj, ensure_ascii=False).encode('UTF-8')
+        for size in [ 1, 7, len(content) ]:
+            chunks = [ content[i:i + size] for i in range(0, len(content), size) ]
+            decoded = self.runner.decode_stream(chunks, frozenset(['hostname', 'serialnumber']))
+            self.assertEqual(decoded['warnings'], rj['warnings'])
+            self.assertEqual([ row['metric'] for row in decoded['data']['result'] ],
+                             [ {'hostname': 'h\u00f6st', 'serialnumber': '1'}, {'hostname': 'host', 'serialnumber': '2'} ])
+        error = {'status': 'error', 'errorType': 'bad_data', 'error': 'parse error'}
+        self.assertEqual(self.runner.decode_stream([ json.dumps(error).encode('UTF-8') ]), error)
+
+    def test_inventory_record(self):
+        r = InventoryRecord('Server', 'location', [ 'servers', 'node_dmi_hardware_info' ])
+        r['serial'] = 'ABC'
+        r['slot'] = 'A1'
+        self.assertNotIn('ignored', r)
+        r['ignored'] = True
+        r['sources'] += [ 'http://prom2:9090' ]
+        self.assertRaises(TypeError, r['sources'].append, 'lost')
+        self.assertEqual(dict(r), {'type': 'Server', 'brand': '', 'model': '', 'serial': 'ABC', 'location': '',
+                                   'extra': [], 'sources': [ 'servers', 'node_dmi_hardware_info', 'http://prom2:9090' ],
+                                   'collisions': 'location', 'ignored': True, 'slot': 'A1'})
+        self.assertEqual(pickle.loads(pickle.dumps(r)), r)
+        self.assertRaises(KeyError, lambda: r['missing'])
+        self.assertFalse(hasattr(r, '__dict__'))
+
+    def test_output_formats(self):
+        for i, serial in enumerate([ 'S1', 'S,2' ]):
+            self.runner.push_row({'type': 'Server', 'brand': 'Dell', 'model': 'R640', 'serial': serial, 'location': 'h%d' % i,
+                                  'extra': [ 'a', 'b' ], 'sources': [ 'servers' ], 'collisions': 'location'}, self.runner.DB)
+        self.runner.OUTPUT_CHUNK = 1
+        out = {}
+        for output in [ 'csv', 'jsonl', 'json' ]:
+            self.options.output = output
+            buf = io.StringIO()
+            self.runner.print_results(buf)
+            out[output] = buf.getvalue()
+        rows = list(csv.reader(io.StringIO(out['csv'])))
+        self.assertEqual(rows[0], [ 'Type', 'Brand', 'Model', 'Serial', 'Location/Owner', 'Extra', 'Sources' ])
+        self.assertEqual(rows[2], [ 'Server', 'Dell', 'R640', 'S,2', 'h1', 'a;b', 'servers' ])
+        records = json.loads(out['json'])
+        self.assertEqual(records, [ json.loads(line) for line in out['jsonl'].splitlines() ])
+        self.assertEqual(records[1]['extra'], [ 'a', 'b' ])
+        self.runner.DB = InventoryDB()
+        buf = io.StringIO()
+        self.runner.print_results(buf)
+        self.assertEqual(json.loads(buf.getvalue()), [])
+        # messages never mix with the rows
+        with unittest.mock.patch('sys.stdout', io.StringIO()) as stdout, unittest.mock.patch('sys.stderr', io.StringIO()) as stderr:
+            self.runner.error('Prometheus query failed')
+            self.runner.print_results()
+        self.assertEqual(json.loads(stdout.getvalue()), [])
+        self.assertEqual(stderr.getvalue(), '[ERROR] Prometheus query failed\n')
+
+    def test_snapshot_diff(self):
+        def push(serial, location, model, rule='disks'):
+            self.runner.push_row({'type': 'Disk', 'brand': 'HP', 'model': model, 'serial': serial, 'location': location,
+                                  'extra': [], 'sources': [ rule ], 'collisions': 'location'}, self.runner.DB)
+        for i in range(5):
+            push('S%d' % i, 'h1', 'M1')
+        push('', 'h2', 'M1', 'servers')
+        push('', 'h2', 'M1', 'servers')
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.runner.save_snapshot(path)
+        self.assertEqual(list(self.runner.diff_snapshot(path)), [])
+        self.runner.DB = InventoryDB()
+        for i in range(1, 5):
+            push('S%d' % i, 'h1', 'M2' if i == 3 else 'M1')
+        push('S9', 'h1', 'M1')
+        push('', 'h2', 'M1', 'servers')
+        push('', 'h2', 'M1', 'servers')
+        changes = sorted([ (c['change'], c['serial'], c['model'], c['previous']) for c in self.runner.diff_snapshot(path) ])
+        self.assertEqual(changes, [ ('added', 'S9', 'M1', {}), ('changed', 'S3', 'M2', {'model': 'M1'}), ('removed', 'S0', 'M1', {}) ])
+        # rows of unchanged rules are not even decoded
+        self.assertIsNone(self.runner.load_snapshot(path, {'servers': self.runner.get_snapshot()['servers'][0]})['servers'][1])
+
+    def test_profile(self):
+        self.use_config(SERVERS_CONFIG)
+        self.runner.get_results = self.mocked_get_results
+        self.options.profile = True
+        self.options.profile_json = os.path.join(tempfile.mkdtemp(), 'profile.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.options.profile_json))
+        self.responses = {'node_dmi_hardware_info': response(series('node_dmi_hardware_info', hostname='a', serialnumber='1'),
+                                                             series('node_dmi_hardware_info', hostname='b', serialnumber='2'))}
+        with open(os.devnull, 'w') as devnull, unittest.mock.patch('sys.stderr', devnull):
+            self.runner.run()
+        with open(self.options.profile_json) as f:
+            profile = json.load(f)
+        self.assertEqual([ (r['rule'], r['rows_in'], r['rows_emitted'], r['rows_ignored']) for r in profile['rules'] ], [ ('servers', 2, 2, 0) ])
+        self.assertEqual(list(profile['phases']), [ 'load_config', 'plan_queries', 'prefetch', 'process' ])
+
+    def test_debug_is_lazy(self):
+        class Expensive(object):
+            def __str__(self):
+                raise AssertionError('formatted while debug is off')
+        self.runner.debug(4, 'row: %s', Expensive())
+
+    def test_fleet_over_http(self):
+        responses = fleet.generate(40)
+        self.serve(StubPrometheus(responses))
+        self.runner.run()
+        offline = self.run_offline(responses)
+        self.assertSameRows(self.runner.DB, offline.DB)
+        self.assertEqual(len([ r for r in offline.DB if r['model'] == 'DCS-7048T-A' and r['sources'][0] == 'switch:arista' ]), 1)
+
+    def test_parallel_processing_matches_serial(self):
+        responses = fleet.generate(60)
+        self.options.config = './configmap-prom-inventory.yaml'
+        self.options.hide_ignored = False
+        self.options.workers = 1
+        serial = self.run_offline(responses)
+        self.options.workers = 3
+        runner = self.run_offline(responses)
+        self.assertSameRows(runner.DB, serial.DB)
+        record = runner.DB[0]
+        self.assertEqual(dict(pickle.loads(pickle.dumps(record))), dict(record))
+        # workers report the same errors, without querying again
+        self.options.prom_endpoint = 'http://127.0.0.1:1'
+        self.options.retries = 0
+        errors = []
+        for workers in [ 1, 3 ]:
+            self.options.workers = workers
+            errors += [ PrometheusInventory(self.options).run() ]
+        self.assertEqual(errors[0], errors[1])
+        self.assertTrue(errors[1]['servers'].startswith('Prometheus query failed for metric [node_dmi_hardware_info]: request failed'))
+
+    def test_lookback_finds_missed_scrapes(self):
+        responses = response(series('node_dmi_hardware_info', hostname='a', serialnumber='1'),
+                             series('node_dmi_hardware_info', hostname='b', serialnumber='2'))
+        # b was last scraped 3 hours ago
+        responses['data']['result'][1]['value'] = [ 1600000000.0 - 3 * 3600, '1' ]
+        stub = self.serve(StubPrometheus({'node_dmi_hardware_info': responses}), SERVERS_CONFIG)
+        self.runner.run()
+        self.assertEqual([ r['location'] for r in self.runner.DB ], [ 'a' ])
+        for window, queries in [ ('', 1), ('2h', 3) ]:
+            self.options.lookback = '6h'
+            self.options.lookback_window = window
+            stub.queries = []
+            runner = PrometheusInventory(self.options)
+            runner.run()
+            self.assertEqual(len(stub.queries), queries)
+            self.assertEqual([ (r['location'], r['last_seen']) for r in runner.DB ], [ ('a', 1600000000), ('b', 1600000000 - 3 * 3600) ])
+        self.options.output = 'csv'
+        out = io.StringIO()
+        runner.print_results(out)
+        self.assertIn(',2020-09-13T09:26:40Z', out.getvalue())
+
+    def test_sharding_on_too_many_samples(self):
+        responses = fleet.generate(40)
+        stub = self.serve(StubPrometheus(responses, max_samples=150))
+        self.runner.run()
+        self.assertEqual(self.runner.FAILURES, {})
+        self.assertTrue([ query for query in stub.queries if 'instance=~"[0-3](?s:.*)"' in query ])
+        self.assertSameRows(self.runner.DB, self.run_offline(responses).DB, ordered=False)
+        key = lambda r: json.dumps(dict(r), sort_keys=True, default=list)
+        # the shards' series are all there, once
+        self.options.shards = 20
+        self.options.shard_label = 'hostname'
+        stub.max_samples = None
+        runner = PrometheusInventory(self.options)
+        rj = runner.get_results({'metric': 'node_dmi_memory_device'})
+        self.assertEqual(sorted([ key(s['metric']) for s in rj['data']['result'] ]),
+                         sorted([ key(s['metric']) for s in responses['node_dmi_memory_device']['data']['result'] ]))
+        # no shard can be small enough: given up at --max-shards
+        stub.max_samples = 0
+        stub.queries = []
+        self.options.shards = 1
+        self.options.max_shards = 20
+        runner = PrometheusInventory(self.options)
+        rj = runner.get_results({'metric': 'node_dmi_memory_device'})
+        self.assertEqual((rj['status'], rj['errorType']), ('http code: 422', 'execution'))
+        self.assertLessEqual(len(stub.queries), 1 + 20 + 8)
+        # other errors evaluating the query are not about its size
+        self.assertFalse(runner.is_size_error({'status': 'http code: 422', 'errorType': 'execution', 'error': 'vector cannot contain metrics with the same labelset'}))
+        self.assertTrue(runner.is_size_error({'status': 'http code: 413'}))
+
+    def test_batch_queries(self):
+        responses = fleet.generate(40)
+        stub = self.serve(StubPrometheus(responses))
+        self.runner.run()
+        queries = len(stub.queries)
+        self.options.batch_queries = True
+        self.options.batch_max_series = 500
+        stub.queries = []
+        batched = PrometheusInventory(self.options)
+        batched.run()
+        self.assertSameRows(batched.DB, self.runner.DB)
+        self.assertLess(len(stub.queries), queries / 2)
+        self.assertTrue(stub.queries[0].startswith('count by (__name__) ({__name__=~"'))
+        self.assertTrue([ query for query in stub.queries if '|entPhysicalMfgName|' in query ])
+        # too many series for a single batch: node_dmi_memory_device is queried alone
+        self.assertFalse([ query for query in stub.queries[1:] if '|node_dmi_memory_device' in query or 'node_dmi_memory_device|' in query ])
+
+    def test_async_deadline_and_cancellation(self):
+        self.use_config(DISKS_CONFIG)
+        self.options.exception = ''
+        released = threading.Event()
+        self.addCleanup(released.set)
+        self.responses = {'megaraid_pd_info': response(series('megaraid_pd_info', hostname='a', serial='S1', model='WDC X')),
+                          'smartmon_device_info': {'status': 'http code: 500'}}
+
+        def get_results(entry, endpoint=None):
+            if entry['metric'] == 'smartmon_device_info':
+                released.wait(10)
+            return self.mocked_get_results(entry, endpoint)
+        self.runner.get_results = get_results
+
+        async def collect():
+            return [ result async for result in self.runner.aiter_rules(deadline=0.5) ]
+        results = asyncio.run(collect())
+        self.assertEqual([ (r.rule, len(r.rows), r.error) for r in results ], [ ('disk:megaraid', 1, None), ('disk:smartmon', 0, 'deadline exceeded') ])
+        self.assertEqual(results[0].rows[0]['serial'], 'S1')
+        self.assertEqual(self.runner.ERRORS, {'disk:smartmon': 'deadline exceeded'})
+        self.assertEqual(self.runner.FAILURES, {'smartmon_device_info': 1})
+
+        # cancelled: no more queries, the DB keeps the rules processed so far
+        cancelled = PrometheusInventory(self.options)
+        cancelled.get_results = get_results
+
+        async def cancel():
+            task = asyncio.ensure_future(cancelled.arun())
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(cancel())
+        self.assertEqual([ r['serial'] for r in cancelled.DB ], [ 'S1' ])
+        # only the threads of the cancelled run stop querying
+        self.assertFalse(cancelled.is_cancelled())
+        self.assertEqual(cancelled.get_results({'metric': 'megaraid_pd_info'})['status'], 'success')
+
+        # run() is arun() to the end: partial results, and the error of each rule that failed
+        released.set()
+        failed = PrometheusInventory(self.options)
+        failed.get_results = self.mocked_get_results
+        self.assertEqual(failed.run(), {'disk:smartmon': 'Prometheus query failed for metric [smartmon_device_info]: http code: 500'})
+        self.assertEqual([ r['serial'] for r in failed.DB ], [ 'S1' ])
+
+    def test_deadline_caps_queries(self):
+        # accepts connections, never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(8)
+        self.addCleanup(server.close)
+        self.use_config(SERVERS_CONFIG)
+        self.options.prom_endpoint = 'http://127.0.0.1:%d' % server.getsockname()[1]
+        self.options.read_timeout = 10
+        self.options.retries = 1
+        self.options.deadline = 1
+        start = time.monotonic()
+        errors = self.runner.run()
+        for thread in threading.enumerate():
+            if thread.name.startswith('ThreadPoolExecutor'):
+                thread.join(10)
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertEqual(errors, {'servers': 'deadline exceeded'})
+        self.assertEqual(self.runner.get_timeout(), (5.0, 10.0))
+
+
+SERVERS_CONFIG = """
+map:
+- name: servers
+  metric: node_dmi_hardware_info
+  labels:
+    location: hostname
+    serial: serialnumber
+  type: Server
+"""
+
+UPS_CONFIG = """
+map:
+- name: ups
+  metric: upsAdvIdentSerialNumber
+  labels:
+    serial: upsAdvIdentSerialNumber
+    location: hostname
+    model: _model
+    brand: _brand
+  type: UPS
+  join:
+  - metric: upsBasicIdentModel
+    labels:
+      _model: upsBasicIdentModel
+      _brand: upsBasicIdentName
+    index:
+    - hostname
+- name: ups-again
+  metric: upsAdvIdentSerialNumber
+  labels:
+    serial: upsAdvIdentSerialNumber
+    location: hostname
+    model: _model
+    brand: _brand
+  type: UPS
+  join:
+  - metric: upsBasicIdentModel
+    labels:
+      _model: upsBasicIdentModel
+      _brand: upsBasicIdentName
+    index:
+    - hostname
+"""
+
+DISKS_CONFIG = """
+map:
+- name: disk:megaraid
+  metric: megaraid_pd_info
+  labels:
+    location: hostname
+    serial: serial
+    model: model
+  regexp:
+    model: ^(?P<brand>\\S+)\\s+(?P<model>.*)$
+  type: Disk
+- name: disk:smartmon
+  metric: smartmon_device_info
+  labels:
+    location: hostname
+    serial: serial_number
+  regexp:
+    device_model: ^(?P<brand>\\S+)\\s+(?P<model>.*)$
+  type: Disk
+correlate:
+- type: Disk
+  primary: [ 'disk:megaraid' ]
+  secondary: [ 'disk:smartmon' ]
+  normalize:
+    prefixes: [ 'WD-' ]
+"""
@@ -1,7 +1,9 @@
+import os
 import unittest
 
 import test_common
 import fixtures_input
+import fleet
 
 from nose.plugins.attrib import attr
 
@@ -10,14 +12,22 @@ from PrometheusInventory import PrometheusInventory
 import json
 
 TESTDATA_FOLDER='./tests/data'
+FLEET_HOSTS=200
 
 @attr('offline')
 @attr('input')
 class PvUsrMgrInputTests(fixtures_input.PromInvInputTests):
 
+    @classmethod
+    def setUpClass(cls):
+        # for the metrics without datasets in tests/data: a small synthetic fleet, generated once
+        cls.fleet = fleet.generate(FLEET_HOSTS)
 
-    def mocked_get_results(self, entry):
-        with open(TESTDATA_FOLDER + '/' + entry['metric'] + '.json') as json_file:
+    def mocked_get_results(self, entry, endpoint=None):
+        path = TESTDATA_FOLDER + '/' + entry['metric'] + '.json'
+        if not os.path.exists(path):
+            return self.fleet.get(entry['metric'], {'status': 'success', 'data': {'resultType': 'vector', 'result': []}})
+        with open(path) as json_file:
             return json.load(json_file)
 
     def setUp(self):